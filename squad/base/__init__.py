@@ -1,4 +1,4 @@
 from base.argument_parser import ArgumentParser
-from base.file_interface import FileInterface
+from base.file_interface import FileInterface, read_report
 from base.processor import Processor, Sampler
 from base.model import Model, Loss
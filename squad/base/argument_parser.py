@@ -30,19 +30,45 @@ class ArgumentParser(argparse.ArgumentParser):
         self.add_argument('--cache_path', type=str, default=None)
         self.add_argument('--question_emb_dir', type=str, default=None)
         self.add_argument('--context_emb_dir', type=str, default=None)
+        self.add_argument('--export_dir', type=str, default=None, help='location for TorchScript encoders')
+        self.add_argument('--index_dir', type=str, default=None,
+                          help='if given, embedded contexts are also added to this phrase index (`piqa_index.py`)')
 
         self.add_argument('--epochs', type=int, default=20)
         self.add_argument('--train_steps', type=int, default=0)
         self.add_argument('--eval_steps', type=int, default=1000)
         self.add_argument('--eval_save_period', type=int, default=500)
         self.add_argument('--report_period', type=int, default=100)
+        self.add_argument('--keep_last', type=int, default=0,
+                          help='if positive, save at every eval and keep this many latest checkpoints')
+        self.add_argument('--keep_best', type=int, default=0, help='if positive, keep this many best checkpoints')
 
         # Other arguments
         self.add_argument('--draft', default=False, action='store_true')
         self.add_argument('--cuda', default=False, action='store_true')
         self.add_argument('--preload', default=False, action='store_true')
         self.add_argument('--cache', default=False, action='store_true')
+        self.add_argument('--num_workers', type=int, default=0, help='number of data loading processes for `train`')
+        self.add_argument('--num_procs', type=int, default=1,
+                          help='number of data-parallel `train` processes (CPU, gloo backend)')
+        self.add_argument('--async_eval', default=False, action='store_true',
+                          help='evaluate on dev in a separate process during `train`')
+        self.add_argument('--dist_url', type=str, default='tcp://127.0.0.1:29500',
+                          help='rendezvous address of the `train` processes')
         self.add_argument('--dump_period', type=int, default=20)
+        self.add_argument('--timing', default=False, action='store_true',
+                          help='time each stage (load, preprocess, collate, copy, forward, ...) into the report')
+        self.add_argument('--profile', default=False, action='store_true', help='save a `torch.profiler` trace')
+        self.add_argument('--profile_start', type=int, default=10, help='first profiled step (or batch)')
+        self.add_argument('--profile_steps', type=int, default=5, help='number of profiled steps (or batches)')
+        self.add_argument('--profile_dir', type=str, default=None, help='location for profiler traces')
+        self.add_argument('--quantize', default=False, action='store_true',
+                          help='dynamic int8 quantization for CPU inference (`test` and `embed`)')
+
+        # Windowed context encoding. Only valid for `embed_context`
+        self.add_argument('--context_window', type=int, default=0,
+                          help='if positive, encode contexts in overlapping windows of this many words')
+        self.add_argument('--context_stride', type=int, default=None, help='defaults to half of `context_window`')
 
     def parse_args(self, **kwargs):
         args = super().parse_args()
@@ -62,11 +88,23 @@ class ArgumentParser(argparse.ArgumentParser):
             args.question_emb_dir = os.path.join(args.output_dir, 'question_emb')
         if args.context_emb_dir is None:
             args.context_emb_dir = os.path.join(args.output_dir, 'context_emb')
+        if args.profile_dir is None:
+            args.profile_dir = os.path.join(args.output_dir, 'profile')
+        if args.export_dir is None:
+            args.export_dir = os.path.join(args.output_dir, 'export')
         if args.report_path is None:
-            args.report_path = os.path.join(args.output_dir, 'report.csv')
+            args.report_path = os.path.join(args.output_dir, 'report.jsonl')
         if args.pred_path is None:
             args.pred_path = os.path.join(args.output_dir, 'pred.json')
         if args.cache_path is None:
             args.cache_path = os.path.join(args.output_dir, 'cache.b')
+        if args.context_stride is None:
+            args.context_stride = max(args.context_window // 2, 1)
+        if args.quantize:
+            assert not args.cuda, '`--quantize` is only supported on CPU.'
+        if args.num_procs > 1:
+            assert not args.cuda, '`--num_procs` is only supported on CPU.'
+        if args.context_window > 0:
+            assert args.mode == 'embed_context', '`--context_window` is only supported for `embed_context` mode.'
 
         return args
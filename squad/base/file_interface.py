@@ -1,15 +1,24 @@
 import json
 import os
+import shutil
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
 import torch
+from torch import nn
 
 import scipy.sparse
 import numpy as np
-import csv
+
+
+REPORT_SYNC_PERIOD = 60
 
 
 class FileInterface(object):
     def __init__(self, save_dir, report_path, pred_path, question_emb_dir, context_emb_dir,
-                 cache_path, dump_dir, train_path, test_path, draft, **kwargs):
+                 cache_path, dump_dir, train_path, test_path, draft, export_dir=None, keep_last=0, keep_best=0,
+                 **kwargs):
         self._train_path = train_path
         self._test_path = test_path
         self._save_dir = save_dir
@@ -19,26 +28,63 @@ class FileInterface(object):
         self._question_emb_dir = question_emb_dir
         self._context_emb_dir = context_emb_dir
         self._cache_path = cache_path
+        self._export_dir = export_dir
         self._draft = draft
         self._save = None
         self._load = None
-        self._report_header = []
-        self._report = []
+        self._save_slim = None
+        self._report_fp = None
+        self._report_sync_time = 0.0
+        self._keep_last = keep_last
+        self._keep_best = keep_best
+        self._checkpoints = []
+        self._saver = ThreadPoolExecutor(max_workers=1)
+        self._pending = []
         self._kwargs = kwargs
 
-    def _bind(self, save=None, load=None):
+    def _bind(self, save=None, load=None, save_slim=None):
         self._save = save
         self._load = load
+        self._save_slim = save_slim
 
-    def save(self, iteration, save_fn=None):
+    def save(self, iteration, save_fn=None, score=None, **kwargs):
+        """Saves a checkpoint in the background (see `bind`), then applies the retention policy: among the checkpoints
+        of this run, only the last `keep_last`, the `keep_best` with the highest `score` and the best one are kept (if
+        either is set).
+        """
         filename = os.path.join(self._save_dir, str(iteration))
         if not os.path.exists(filename):
             os.makedirs(filename)
         if save_fn is None:
             save_fn = self._save
-        save_fn(filename)
+        save_fn(filename, **kwargs)
+        self._checkpoints.append((iteration, score))
+        if self._keep_last > 0 or self._keep_best > 0:
+            # Decided here, on the checkpoints submitted so far; the saver thread only deletes, after the pending saves
+            removed = _retain(list(self._checkpoints), self._keep_last, self._keep_best)
+            self._checkpoints = [each for each in self._checkpoints if each[0] not in removed]
+            if removed:
+                self._submit(self._remove, removed)
+
+    def flush(self):
+        """Waits for the pending background saves, and raises their errors, if any."""
+        pending, self._pending = self._pending, []
+        for future in pending:
+            future.result()
+
+    def _submit(self, fn, *args):
+        # A single worker, so that saves and deletions happen in order. Errors of finished ones are raised here.
+        for future in [future for future in self._pending if future.done()]:
+            self._pending.remove(future)
+            future.result()
+        self._pending.append(self._saver.submit(fn, *args))
 
-    def load(self, iteration, load_fn=None, session=None):
+    def _remove(self, iterations):
+        for iteration in iterations:
+            shutil.rmtree(os.path.join(self._save_dir, str(iteration)), ignore_errors=True)
+            print('Model removed from %s' % os.path.join(self._save_dir, str(iteration)))
+
+    def load(self, iteration, load_fn=None, session=None, slim=True):
         if session is None:
             session = self._save_dir
         filename = os.path.join(session, str(iteration), 'model.pt')
@@ -47,7 +93,25 @@ class FileInterface(object):
             os.makedirs(dirname)
         if load_fn is None:
             load_fn = self._load
-        load_fn(filename)
+        load_fn(filename, slim=slim)
+
+    def save_slim(self, iteration, save_slim_fn=None, session=None):
+        """Saves an inference-only checkpoint next to `model.pt`, which `load` then prefers when there is no optimizer.
+        """
+        if session is None:
+            session = self._save_dir
+        dirname = os.path.join(session, str(iteration), 'slim')
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        if save_slim_fn is None:
+            save_slim_fn = self._save_slim
+        save_slim_fn(dirname)
+
+    def shared_weights(self):
+        """Returns a dict from state dict key suffixes to `.npy` paths, for the weights that slim checkpoints store by
+        reference (e.g. pretrained embeddings, which are identical in every checkpoint).
+        """
+        return {}
 
     def pred(self, pred):
         if not os.path.exists(os.path.dirname(self._pred_path)):
@@ -57,25 +121,19 @@ class FileInterface(object):
             print('Prediction saved at %s' % self._pred_path)
 
     def report(self, summary=False, **kwargs):
-        if not os.path.exists(os.path.dirname(self._report_path)):
-            os.makedirs(os.path.dirname(self._report_path))
-        if len(self._report) == 0 and os.path.exists(self._report_path):
-            with open(self._report_path, 'r') as fp:
-                reader = csv.DictReader(fp, delimiter=',')
-                rows = list(reader)
-                for key in rows[0]:
-                    if key not in self._report_header:
-                        self._report_header.append(key)
-                self._report.extend(rows)
-
-        for key, val in kwargs.items():
-            if key not in self._report_header:
-                self._report_header.append(key)
-        self._report.append(kwargs)
-        with open(self._report_path, 'w') as fp:
-            writer = csv.DictWriter(fp, delimiter=',', fieldnames=self._report_header)
-            writer.writeheader()
-            writer.writerows(self._report)
+        """Appends `kwargs` to the report as a JSON line, so rows may have different columns (see `read_report`).
+
+        Each row is flushed right away, but fsynced only for summaries or every `REPORT_SYNC_PERIOD` seconds.
+        """
+        if self._report_fp is None:
+            if not os.path.exists(os.path.dirname(self._report_path)):
+                os.makedirs(os.path.dirname(self._report_path))
+            self._report_fp = open(self._report_path, 'a')
+        self._report_fp.write(json.dumps(kwargs, default=float) + '\n')
+        self._report_fp.flush()
+        if summary or time.time() - self._report_sync_time > REPORT_SYNC_PERIOD:
+            os.fsync(self._report_fp.fileno())
+            self._report_sync_time = time.time()
         return ', '.join('%s=%.5r' % (s, r) for s, r in kwargs.items())
 
     def question_emb(self, id_, emb, emb_type='dense'):
@@ -86,6 +144,9 @@ class FileInterface(object):
         savez(path, emb)
 
     def context_emb(self, id_, phrases, emb, emb_type='dense'):
+        """Saves the phrase vectors `emb` of a context, and its phrases: either a list of strings, or a dict of the
+        `context` and the int32 [N, 2] character offsets (`spans`) of the phrases, saved as `<id>.spans.npy`.
+        """
         if not os.path.exists(self._context_emb_dir):
             os.makedirs(self._context_emb_dir)
         savez = scipy.sparse.save_npz if emb_type == 'sparse' else np.savez
@@ -99,9 +160,23 @@ class FileInterface(object):
         if os.path.exists(json_path):
             print('Skipping %s; already exists' % json_path)
         else:
+            if isinstance(phrases, dict):
+                np.save(os.path.join(self._context_emb_dir, '%s.spans.npy' % id_), phrases['spans'])
+                phrases = {'context': phrases['context']}
             with open(json_path, 'w') as fp:
                 json.dump(phrases, fp)
 
+    def export(self, modules, processor_state):
+        """Saves TorchScript `modules` as `<name>.pt` and `processor_state` (e.g. vocab dicts) as `processor.json`."""
+        if not os.path.exists(self._export_dir):
+            os.makedirs(self._export_dir)
+        for name, module in modules.items():
+            path = os.path.join(self._export_dir, '%s.pt' % name)
+            torch.jit.save(module, path)
+            print('Exported %s encoder at %s' % (name, path))
+        with open(os.path.join(self._export_dir, 'processor.json'), 'w') as fp:
+            json.dump(processor_state, fp)
+
     def cache(self, preprocess, args):
         if os.path.exists(self._cache_path):
             return torch.load(self._cache_path)
@@ -117,8 +192,14 @@ class FileInterface(object):
         torch.save(item, filename)
 
     def bind(self, processor, model, optimizer=None):
-        def load(filename, **kwargs):
+        def load(filename, slim=True, **kwargs):
             # filename = os.path.join(filename, 'model.pt')
+            slim_dirname = os.path.join(os.path.dirname(filename), 'slim')
+            if slim and optimizer is None and os.path.exists(os.path.join(slim_dirname, 'index.json')):
+                processor.load_state_dict(torch.load(os.path.join(slim_dirname, 'processor.pt')))
+                _load_slim(model, slim_dirname, self.shared_weights())
+                print('Model loaded from %s' % slim_dirname)
+                return
             state = torch.load(filename)
             processor.load_state_dict(state['preprocessor'])
             model.load_state_dict(state['model'])
@@ -126,21 +207,27 @@ class FileInterface(object):
                 optimizer.load_state_dict(state['optimizer'])
             print('Model loaded from %s' % filename)
 
-        def save(filename, **kwargs):
+        def save(filename, model_state=None, optimizer_state=None, **kwargs):
+            # `model_state` and `optimizer_state` save an earlier snapshot instead of the current model.
+            # The state is copied to CPU here, and serialized in the background (written to a temporary file first, so
+            # that `model.pt` is always complete).
             state = {
                 'preprocessor': processor.state_dict(),
-                'model': model.state_dict(),
-                'optimizer': optimizer.state_dict()
+                'model': _cpu_model_state(model) if model_state is None else model_state,
+                'optimizer': _cpu_copy(optimizer.state_dict()) if optimizer_state is None else optimizer_state
             }
-            filename = os.path.join(filename, 'model.pt')
-            torch.save(state, filename)
-            print('Model saved at %s' % filename)
+            self._submit(_save_atomic, state, os.path.join(filename, 'model.pt'))
+
+        def save_slim(dirname, **kwargs):
+            torch.save(processor.state_dict(), os.path.join(dirname, 'processor.pt'))
+            _save_slim(model, dirname, self.shared_weights())
+            print('Slim model saved at %s' % dirname)
 
         def infer(input, top_k=100):
             # input = {'id': '', 'question': '', 'context': ''}
             model.eval()
 
-        self._bind(save=save, load=load)
+        self._bind(save=save, load=load, save_slim=save_slim)
 
     def load_train(self):
         raise NotImplementedError()
@@ -150,3 +237,134 @@ class FileInterface(object):
 
     def load_metadata(self):
         raise NotImplementedError()
+
+
+def _retain(checkpoints, keep_last, keep_best):
+    """Returns the iterations of `checkpoints`, a list of (iteration, score), that the retention policy removes.
+
+    The best scored checkpoint is always kept, so that the best iteration can be loaded later.
+    """
+    keep = set()
+    if keep_last > 0:
+        keep.update(iteration for iteration, _ in checkpoints[-keep_last:])
+    scored = sorted((each for each in checkpoints if each[1] is not None), key=lambda each: -each[1])
+    keep.update(iteration for iteration, _ in scored[:max(keep_best, 1)])
+    return [iteration for iteration, _ in checkpoints if iteration not in keep]
+
+
+def _cpu_model_state(model):
+    """A CPU copy of the state dict of `model`. Frozen parameters (e.g. GloVe) are not copied, as they do not change."""
+    state = OrderedDict()
+    for key, val in model.state_dict(keep_vars=True).items():
+        frozen = isinstance(val, nn.Parameter) and not val.requires_grad
+        state[key] = val.detach().cpu() if frozen else val.detach().cpu().clone()
+    return state
+
+
+def _cpu_copy(obj):
+    if torch.is_tensor(obj):
+        return obj.detach().cpu().clone()
+    if isinstance(obj, dict):
+        return type(obj)((key, _cpu_copy(val)) for key, val in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_cpu_copy(val) for val in obj)
+    return obj
+
+
+def _save_atomic(state, filename):
+    torch.save(state, filename + '.tmp')
+    os.replace(filename + '.tmp', filename)
+    print('Model saved at %s' % filename)
+
+
+def read_report(path):
+    """Reads a report written by `FileInterface.report`.
+
+    Returns the columns (in order of first appearance) and the rows, as a list of dicts. A truncated last line, e.g.
+    of a killed process, is skipped.
+    """
+    header, rows = [], []
+    with open(path, 'r') as fp:
+        for line in fp:
+            try:
+                row = json.loads(line, object_pairs_hook=OrderedDict)
+            except ValueError:
+                continue
+            for key in row:
+                if key not in header:
+                    header.append(key)
+            rows.append(row)
+    return header, rows
+
+
+def _save_slim(model, dirname, shared_weights):
+    """Saves the weights of `model` as one flat, memory-mappable `weights.<dtype>.npy` per dtype, indexed by
+    `index.json`.
+
+    A weight whose key ends with a suffix in `shared_weights` is stored as a reference if it equals that file, and
+    aliases of the same tensor (e.g. a module registered under several names) are stored once.
+    """
+    if os.path.exists(os.path.join(dirname, 'index.json')):
+        os.remove(os.path.join(dirname, 'index.json'))
+    index, chunks, offsets, keys = OrderedDict(), OrderedDict(), {}, {}
+    for key, tensor in model.state_dict().items():
+        tensor_id = (tensor.data_ptr(), tuple(tensor.size()), tensor.dtype)
+        if tensor_id in keys:
+            index[key] = {'alias': keys[tensor_id]}
+            continue
+        keys[tensor_id] = key
+        array = tensor.detach().cpu().numpy()
+        suffix = next((suffix for suffix in shared_weights if key.endswith(suffix)), None)
+        if suffix is not None:
+            shared = np.load(shared_weights[suffix], mmap_mode='r')
+            if shared.shape == array.shape and np.array_equal(shared, array):
+                index[key] = {'shared': suffix}
+                continue
+        dtype = str(array.dtype)
+        offset = offsets.get(dtype, 0)
+        chunks.setdefault(dtype, []).append(array.reshape(-1))
+        offsets[dtype] = offset + array.size
+        index[key] = {'dtype': dtype, 'offset': offset, 'shape': list(array.shape)}
+
+    for dtype, arrays in chunks.items():
+        np.save(os.path.join(dirname, 'weights.%s.npy' % dtype), np.concatenate(arrays))
+    # Written last, so that `load` only picks up complete slim checkpoints
+    with open(os.path.join(dirname, 'index.json'), 'w') as fp:
+        json.dump(index, fp)
+
+
+def _load_slim(model, dirname, shared_weights):
+    """Loads weights saved by `_save_slim`. Files are memory-mapped, and shared weights are assigned to the model
+    without copying, so that only the pages actually used are read.
+    """
+    with open(os.path.join(dirname, 'index.json'), 'r') as fp:
+        index = json.load(fp, object_pairs_hook=OrderedDict)
+    arrays, state = {}, {}
+    for key, entry in index.items():
+        if 'alias' in entry:
+            if entry['alias'] in state:
+                state[key] = state[entry['alias']]
+        elif 'shared' in entry:
+            _assign(model, key, torch.from_numpy(np.load(shared_weights[entry['shared']], mmap_mode='c')))
+        else:
+            if entry['dtype'] not in arrays:
+                arrays[entry['dtype']] = np.load(os.path.join(dirname, 'weights.%s.npy' % entry['dtype']),
+                                                 mmap_mode='c')
+            size = int(np.prod(entry['shape']))
+            array = arrays[entry['dtype']][entry['offset']:entry['offset'] + size]
+            state[key] = torch.from_numpy(array.reshape(entry['shape']))
+    missing = set(model.state_dict()) - set(index)
+    assert len(missing) == 0, 'Missing keys in %s: %s' % (dirname, ', '.join(sorted(missing)))
+    model.load_state_dict(state, strict=False)
+
+
+def _assign(model, key, tensor):
+    module_name, _, name = key.rpartition('.')
+    module = model
+    for each in module_name.split('.') if module_name else ():
+        module = getattr(module, each)
+    old = getattr(module, name)
+    tensor = tensor.to(old.device)
+    if isinstance(old, nn.Parameter):
+        tensor = nn.Parameter(tensor, requires_grad=old.requires_grad)
+    setattr(module, name, tensor)
@@ -20,6 +20,15 @@ class Model(nn.Module, metaclass=ABCMeta):
     def get_question(self, *args, **kwargs):
         raise NotImplementedError()
 
+    def quantize(self):
+        raise NotImplementedError()
+
+    def export(self):
+        """
+        :return: a dict of TorchScript modules
+        """
+        raise NotImplementedError()
+
 
 class Loss(nn.Module, metaclass=ABCMeta):
     def forward(self, *input):
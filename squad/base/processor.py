@@ -28,12 +28,18 @@ class Processor(metaclass=ABCMeta):
     def postprocess_context_batch(self, dataset, model_input, context_output):
         raise NotImplementedError()
 
+    def postprocess_context_window_batch(self, dataset, model_input, context_output):
+        raise NotImplementedError()
+
     def postprocess_question(self, example, question_output):
         raise NotImplementedError()
 
     def postprocess_question_batch(self, dataset, model_input, question_output):
         raise NotImplementedError()
 
+    def window(self, example, window_size, stride):
+        raise NotImplementedError()
+
     def collate(self, examples):
         raise NotImplementedError()
 
@@ -48,3 +54,6 @@ class Sampler(torch.utils.data.Sampler, metaclass=ABCMeta):
     def __init__(self, dataset, data_type, **kwargs):
         self.dataset = dataset
         self.data_type = data_type
+
+    def shard(self, rank, num_procs):
+        raise NotImplementedError()
@@ -1,4 +1,4 @@
 from baseline.argument_parser import ArgumentParser
 from baseline.file_interface import FileInterface
-from baseline.processor import Processor, Sampler
+from baseline.processor import Processor, Sampler, ElmoStore
 from baseline.model import Model, Loss
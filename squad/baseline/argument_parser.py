@@ -16,6 +16,8 @@ class ArgumentParser(base.ArgumentParser):
                           help='location of GloVe')
         self.add_argument('--elmo_options_file', type=str, default=os.path.join(home, 'data', 'elmo', 'options.json'))
         self.add_argument('--elmo_weights_file', type=str, default=os.path.join(home, 'data', 'elmo', 'weights.hdf5'))
+        self.add_argument('--elmo_cache_dir', type=str, default=None,
+                          help='location of ELMo activations precomputed with `--mode cache_elmo`')
 
         # Model arguments
         self.add_argument('--word_vocab_size', type=int, default=10000)
@@ -29,6 +31,13 @@ class ArgumentParser(base.ArgumentParser):
         self.add_argument('--max_pool', default=False, action='store_true')
         self.add_argument('--agg', type=str, default='max', help='max|logsumexp')
         self.add_argument('--num_layers', type=int, default=1)
+        self.add_argument('--max_ans_len', type=int, default=7)
+        self.add_argument('--packed', default=False, action='store_true',
+                          help='run LSTMs on packed sequences to skip computation over pads')
+        self.add_argument('--fused', default=False, action='store_true',
+                          help='run the LSTMs of start and end boundaries as a single fused LSTM')
+        self.add_argument('--att_chunk_size', type=int, default=0,
+                          help='if positive, compute self-attention in blocks of this size with bounded memory')
 
         # Training arguments. Only valid during training
         self.add_argument('--dropout', type=float, default=0.2)
@@ -36,9 +45,19 @@ class ArgumentParser(base.ArgumentParser):
         self.add_argument('--max_question_size', type=int, default=32)
         self.add_argument('--no_bucket', default=False, action='store_true')
         self.add_argument('--no_shuffle', default=False, action='store_true')
+        self.add_argument('--filter_weight', type=float, default=0.0,
+                          help='weight of the loss of the question-independent phrase filter (`--filter_th`)')
 
         # Other arguments
         self.add_argument('--emb_type', type=str, default='dense')
+        self.add_argument('--phrase_strings', default=False, action='store_true',
+                          help='dump phrases as strings instead of the context and character offsets')
+        self.add_argument('--sparse_k', type=int, default=0,
+                          help='if positive, keep only the k largest magnitudes of each phrase/question vector')
+        self.add_argument('--filter_th', type=float, default=0.0,
+                          help='if positive, drop phrases whose filter start prob. * end prob. is below this')
+        self.add_argument('--filter_top_n', type=int, default=0,
+                          help='if positive, keep at most this many phrases per context (or window) by filter prob.')
         self.add_argument('--glove_cuda', default=False, action='store_true')
 
     def parse_args(self, **kwargs):
@@ -51,4 +70,16 @@ class ArgumentParser(base.ArgumentParser):
         args.glove_cpu = not args.glove_cuda
         args.bucket = not args.no_bucket
         args.shuffle = not args.no_shuffle
+        if args.mode == 'cache_elmo':
+            assert args.elmo and args.elmo_cache_dir is not None, \
+                '`cache_elmo` requires `--elmo` and `--elmo_cache_dir`.'
+        if args.quantize:
+            assert not args.fused, '`--quantize` does not support `--fused`.'
+        if args.index_dir is not None:
+            assert args.emb_type == 'dense', 'A phrase index (`--index_dir`) only supports dense embeddings.'
+        if args.sparse_k > 0:
+            assert args.emb_type == 'sparse', '`--sparse_k` requires `--emb_type sparse`.'
+        if args.context_window > 0:
+            assert args.context_window - args.context_stride >= args.max_ans_len - 1, \
+                'windows must overlap by at least `max_ans_len - 1` words so that every phrase fits in a window.'
         return args
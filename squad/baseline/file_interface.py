@@ -20,6 +20,17 @@ class FileInterface(base.FileInterface):
     def load_test(self):
         return _load_squad(self._test_path, draft=self._draft)
 
+    def shared_weights(self):
+        return {'glove_embedding.embedding.weight': self._glove_cache_path()}
+
+    def _glove_cache_path(self):
+        """GloVe as a `.npy` matrix (with the two rows of pad and unk), created from the text file if needed."""
+        path = os.path.join(self._glove_dir, 'glove.6B.%dd.npy' % self._glove_size)
+        if not os.path.exists(path):
+            _, emb_mat = _load_glove(self._glove_size, glove_dir=self._glove_dir)
+            np.save(path, np.concatenate([np.zeros([2, emb_mat.shape[1]], dtype=np.float32), emb_mat], 0))
+        return path
+
     def load_metadata(self):
         glove_vocab, glove_emb_mat = _load_glove(self._glove_size, glove_dir=self._glove_dir, draft=self._draft)
         return {'glove_vocab': glove_vocab,
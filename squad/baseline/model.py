@@ -1,7 +1,15 @@
+import copy
+from collections import OrderedDict
+
 import torch
 from torch import nn
+from torch.nn.utils.rnn import PackedSequence, pack_padded_sequence, pad_packed_sequence
+from torch.utils.checkpoint import checkpoint
 
 import base
+from baseline.processor import SparseTensor
+
+ELMO_NUM_LAYERS = 3  # the character CNN and the two biLSTM layers
 
 
 class CharEmbedding(nn.Module):
@@ -58,9 +66,24 @@ class Highway(nn.Module):
         return output
 
 
+class ScalarMix(nn.Module):
+    """Weighted sum of ELMo's layers by softmax-normalized scalars, scaled by `gamma` (`allennlp`'s `ScalarMix` without
+    layer normalization, with the same parameter names).
+    """
+    def __init__(self, num_layers):
+        super(ScalarMix, self).__init__()
+        self.scalar_parameters = nn.ParameterList([nn.Parameter(torch.zeros(1)) for _ in range(num_layers)])
+        self.gamma = nn.Parameter(torch.ones(1))
+
+    def forward(self, layers):
+        """[..., num_layers, d] -> [..., d]"""
+        weights = torch.softmax(torch.cat(list(self.scalar_parameters)), 0)
+        return self.gamma * weights.matmul(layers)
+
+
 class Embedding(nn.Module):
     def __init__(self, char_vocab_size, glove_vocab_size, word_vocab_size, embed_dim, dropout, elmo=False,
-                 glove_cpu=False):
+                 glove_cpu=False, elmo_cache=False):
         super(Embedding, self).__init__()
         self.word_embedding = WordEmbedding(word_vocab_size, embed_dim)
         self.char_embedding = CharEmbedding(char_vocab_size, embed_dim)
@@ -69,9 +92,14 @@ class Embedding(nn.Module):
         self.highway1 = Highway(self.output_size, dropout)
         self.highway2 = Highway(self.output_size, dropout)
         self.use_elmo = elmo
+        self.elmo_cache = elmo_cache
         self.elmo = None
         if self.use_elmo:
             self.output_size += 1024
+            # the layer mix (and dropout) of ELMo are applied here rather than by `self.elmo`, so that they are the
+            # same (and trained) whether the biLM activations are computed or read from a cache
+            self.elmo_mix = ScalarMix(ELMO_NUM_LAYERS)
+            self.elmo_dropout = nn.Dropout(p=0.0)
 
     def load_glove(self, glove_emb_mat):
         device = self.glove_embedding.embedding.weight.device
@@ -86,24 +114,46 @@ class Embedding(nn.Module):
 
     def init(self, processed_metadata):
         self.load_glove(processed_metadata['glove_emb_mat'])
-        if self.use_elmo:
+        if self.use_elmo and not self.elmo_cache:
             self.load_elmo(processed_metadata['elmo_options_file'], processed_metadata['elmo_weights_file'])
 
-    def forward(self, cx, gx, x, ex=None):
+    def get_elmo(self, ex):
+        """The activations of each layer of ELMo's biLM for character ids `ex`, i.e. [B, T, num_layers, 1024]."""
+        from allennlp.nn.util import remove_sentence_boundaries
+        bilm_output = self.elmo._elmo_lstm(ex)
+        assert len(bilm_output['activations']) == ELMO_NUM_LAYERS, len(bilm_output['activations'])
+        layers = [remove_sentence_boundaries(each, bilm_output['mask'])[0] for each in bilm_output['activations']]
+        return torch.stack(layers, 2)
+
+    def forward(self, cx, gx, x, ex=None, er=None):
         cx = self.char_embedding(cx)
         gx = self.glove_embedding(gx)
         output = torch.cat([cx, gx], -1)
         output = self.highway2(self.highway1(output))
         if self.use_elmo:
-            elmo, = self.elmo(ex)['elmo_representations']
-            output = torch.cat([output, elmo], 2)
+            # `er` is the precomputed biLM activations, if cached
+            layers = er if er is not None else self.get_elmo(ex)
+            output = torch.cat([output, self.elmo_dropout(self.elmo_mix(layers))], 2)
         return output
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # ELMo's own weights are frozen and loaded from its weights file, so they are not needed with a cache; and
+        # checkpoints from before `elmo_mix` hold the trained layer mix in ELMo's `scalar_mix_0`
+        for key in [key for key in state_dict if key.startswith(prefix + 'elmo.')]:
+            value = state_dict[key] if self.elmo is not None else state_dict.pop(key)
+            old_prefix = prefix + 'elmo.scalar_mix_0.'
+            if key.startswith(old_prefix):
+                state_dict.setdefault(prefix + 'elmo_mix.' + key[len(old_prefix):], value)
+        super(Embedding, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
 
 class SelfSeqAtt(nn.Module):
-    def __init__(self, input_size, hidden_size, dropout):
+    def __init__(self, input_size, hidden_size, dropout, packed=False, chunk_size=0):
         super(SelfSeqAtt, self).__init__()
         self.dropout = torch.nn.Dropout(p=dropout)
+        self.packed = packed
+        self.chunk_size = chunk_size
+        # `query_lstm` is not used (queries share `key_lstm`), but is kept for loading existing checkpoints.
         self.query_lstm = nn.LSTM(input_size=input_size,
                                   hidden_size=hidden_size,
                                   batch_first=True,
@@ -116,22 +166,26 @@ class SelfSeqAtt(nn.Module):
 
     def forward(self, input_, mask):
         input_ = self.dropout(input_)
-        key_input = input_
-        query_input = input_
-        key, _ = self.key_lstm(key_input)
-        query, _ = self.key_lstm(query_input)
-        att = query.matmul(key.transpose(1, 2)) + mask.unsqueeze(1)
-        att = self.softmax(att)
-        output = att.matmul(input_)
+        key = _run_lstm(self.key_lstm, input_, mask, packed=self.packed)
+        query = key
+        if self.chunk_size > 0:
+            output = _chunked_attention(query, key, input_, mask, self.chunk_size)
+        else:
+            att = query.matmul(key.transpose(1, 2)) + mask.unsqueeze(1)
+            att = self.softmax(att)
+            output = att.matmul(input_)
         return {'value': output, 'key': key, 'query': query}
 
 
 class ContextBoundary(nn.Module):
-    def __init__(self, input_size, hidden_size, dropout, num_heads, identity=True, num_layers=1):
+    def __init__(self, input_size, hidden_size, dropout, num_heads, identity=True, num_layers=1, packed=False,
+                 att_chunk_size=0):
         super(ContextBoundary, self).__init__()
         assert num_heads >= 1, num_heads
         self.dropout = torch.nn.Dropout(p=dropout)
         self.num_layers = num_layers
+        self.hidden_size = hidden_size
+        self.packed = packed
         for i in range(self.num_layers):
             self.add_module('lstm%d' % i, torch.nn.LSTM(input_size=input_size,
                                                         hidden_size=hidden_size,
@@ -142,13 +196,21 @@ class ContextBoundary(nn.Module):
         self.att_num_heads = num_heads - 1 if identity else num_heads
         for i in range(self.att_num_heads):
             self.add_module('self_att%d' % i,
-                            SelfSeqAtt(hidden_size * 2, hidden_size, dropout))
+                            SelfSeqAtt(hidden_size * 2, hidden_size, dropout, packed=packed,
+                                       chunk_size=att_chunk_size))
 
     def forward(self, x, m):
+        return self.attend(self.encode(x, m), m)
+
+    def encode(self, x, m):
         modules = dict(self.named_children())
         x = self.dropout(x)
         for i in range(self.num_layers):
-            x, _ = modules['lstm%d' % i](x)
+            x = _run_lstm(modules['lstm%d' % i], x, m, packed=self.packed)
+        return x
+
+    def attend(self, x, m):
+        modules = dict(self.named_children())
         atts = [x] if self.identity else []
         for i in range(self.att_num_heads):
             a = modules['self_att%d' % i](x, m)
@@ -159,12 +221,14 @@ class ContextBoundary(nn.Module):
 
 
 class QuestionBoundary(ContextBoundary):
-    def __init__(self, input_size, hidden_size, dropout, num_heads, max_pool=False):
-        super(QuestionBoundary, self).__init__(input_size, hidden_size, dropout, num_heads, identity=False)
+    def __init__(self, input_size, hidden_size, dropout, num_heads, max_pool=False, packed=False,
+                 att_chunk_size=0):
+        super(QuestionBoundary, self).__init__(input_size, hidden_size, dropout, num_heads, identity=False,
+                                               packed=packed, att_chunk_size=att_chunk_size)
         self.max_pool = max_pool
 
-    def forward(self, x, m):
-        d = super().forward(x, m)
+    def attend(self, x, m):
+        d = super().attend(x, m)
         if self.max_pool:
             dense = d['dense'].max(1)[0]
         else:
@@ -187,23 +251,40 @@ class Model(base.Model):
                  agg='max',
                  num_layers=1,
                  glove_cpu=False,
+                 packed=False,
+                 att_chunk_size=0,
+                 fused=False,
+                 elmo_cache_dir=None,
+                 sparse_k=0,
+                 filter_th=0.0,
+                 filter_top_n=0,
                  **kwargs):
         super(Model, self).__init__()
         self.embedding = Embedding(char_vocab_size, glove_vocab_size, word_vocab_size, embed_size, dropout,
-                                   elmo=elmo, glove_cpu=glove_cpu)
+                                   elmo=elmo, glove_cpu=glove_cpu, elmo_cache=elmo_cache_dir is not None)
         self.context_embedding = self.embedding
         self.question_embedding = self.embedding
         word_size = self.embedding.output_size
         context_input_size = word_size
         question_input_size = word_size
-        self.context_start = ContextBoundary(context_input_size, hidden_size, dropout, num_heads, num_layers=num_layers)
-        self.context_end = ContextBoundary(context_input_size, hidden_size, dropout, num_heads, num_layers=num_layers)
+        self.context_start = ContextBoundary(context_input_size, hidden_size, dropout, num_heads, num_layers=num_layers,
+                                             packed=packed, att_chunk_size=att_chunk_size)
+        self.context_end = ContextBoundary(context_input_size, hidden_size, dropout, num_heads, num_layers=num_layers,
+                                           packed=packed, att_chunk_size=att_chunk_size)
         self.agg = agg
-        self.question_start = QuestionBoundary(question_input_size, hidden_size, dropout, num_heads, max_pool=max_pool)
-        self.question_end = QuestionBoundary(question_input_size, hidden_size, dropout, num_heads, max_pool=max_pool)
+        self.question_start = QuestionBoundary(question_input_size, hidden_size, dropout, num_heads, max_pool=max_pool,
+                                               packed=packed, att_chunk_size=att_chunk_size)
+        self.question_end = QuestionBoundary(question_input_size, hidden_size, dropout, num_heads, max_pool=max_pool,
+                                             packed=packed, att_chunk_size=att_chunk_size)
         self.softmax = nn.Softmax(dim=1)
         self.max_ans_len = max_ans_len
         self.linear = nn.Linear(word_size, 1)
+        self.fused = fused
+        self._fused_lstms = {}  # (start, end) boundaries -> _FusedLSTM, which caches the fused weights
+        self.packed = packed
+        self.sparse_k = sparse_k
+        self.filter_th = filter_th
+        self.filter_top_n = filter_top_n
 
     def forward(self,
                 context_char_idxs,
@@ -214,22 +295,24 @@ class Model(base.Model):
                 question_word_idxs,
                 context_elmo_idxs=None,
                 question_elmo_idxs=None,
+                context_elmo_reps=None,
+                question_elmo_reps=None,
                 num_samples=None,
                 **kwargs):
-        q = self.question_embedding(question_char_idxs, question_glove_idxs, question_word_idxs, ex=question_elmo_idxs)
-        x = self.context_embedding(context_char_idxs, context_glove_idxs, context_word_idxs, ex=context_elmo_idxs)
+        q = self.question_embedding(question_char_idxs, question_glove_idxs, question_word_idxs, ex=question_elmo_idxs,
+                                    er=question_elmo_reps)
+        x = self.context_embedding(context_char_idxs, context_glove_idxs, context_word_idxs, ex=context_elmo_idxs,
+                                   er=context_elmo_reps)
 
         mq = ((question_glove_idxs == 0).float() * -1e9)
-        qd1 = self.question_start(q, mq)
-        qd2 = self.question_end(q, mq)
+        qd1, qd2 = self._boundaries(self.question_start, self.question_end, q, mq)
         q1 = qd1['dense']
         q2 = qd2['dense']
         # print(qs1[0, question_word_idxs[0] > 0])
 
         mx = (context_glove_idxs == 0).float() * -1e9
 
-        hd1 = self.context_start(x, mx)
-        hd2 = self.context_end(x, mx)
+        hd1, hd2 = self._boundaries(self.context_start, self.context_end, x, mx)
         x1 = hd1['dense']
         x2 = hd2['dense']
 
@@ -245,6 +328,9 @@ class Model(base.Model):
         _, yp1 = prob.max(2)[0].max(1)
         _, yp2 = prob.max(1)[0].max(1)
 
+        # question-independent start/end logits of each context word, for phrase filtering
+        filter_logits = self.linear(x).squeeze(2)
+
         return {'logits1': logits1,
                 'logits2': logits2,
                 'yp1': yp1,
@@ -252,54 +338,339 @@ class Model(base.Model):
                 'x1': x1,
                 'x2': x2,
                 'q1': q1,
-                'q2': q2}
+                'q2': q2,
+                'filter_logits': filter_logits}
 
     def init(self, processed_metadata):
         self.embedding.init(processed_metadata)
 
-    def get_context(self, context_char_idxs, context_glove_idxs, context_word_idxs, context_elmo_idxs=None, **kwargs):
+    def get_context(self, context_char_idxs, context_glove_idxs, context_word_idxs, context_elmo_idxs=None,
+                    context_elmo_reps=None, **kwargs):
         l = (context_glove_idxs > 0).sum(1)
-        mx = (context_glove_idxs == 0).float() * -1e9
-        x = self.context_embedding(context_char_idxs, context_glove_idxs, context_word_idxs, ex=context_elmo_idxs)
-        xd1 = self.context_start(x, mx)
-        x1 = xd1['dense']
-        xd2 = self.context_end(x, mx)
-        x2 = xd2['dense']
+        x1, x2, x = self._encode_context(context_char_idxs, context_glove_idxs, context_word_idxs,
+                                         context_elmo_idxs=context_elmo_idxs, context_elmo_reps=context_elmo_reps)
+        filtered = self.filter_th > 0 or self.filter_top_n > 0
+        filter_probs = torch.sigmoid(self.linear(x).squeeze(2)) if filtered else None
         out = []
         for k, (lb, x1b, x2b) in enumerate(zip(l, x1, x2)):
             pos_list = []
-            vec_list = []
             for i in range(lb):
                 for j in range(i, min(i + self.max_ans_len, lb)):
-                    vec = torch.cat([x1b[i], x2b[j]], 0)
                     pos_list.append((i, j))
-                    vec_list.append(vec)
+            if filtered:
+                pos_list = self._filter_phrases(pos_list, filter_probs[k])
 
-            dense = torch.stack(vec_list, 0)
-            out.append((tuple(pos_list), dense))
+            starts = torch.tensor([i for i, _ in pos_list], dtype=torch.int64, device=x1b.device)
+            ends = torch.tensor([j for _, j in pos_list], dtype=torch.int64, device=x2b.device)
+            dense = torch.cat([x1b[starts], x2b[ends]], 1)
+            out.append((tuple(pos_list), self._sparsify(dense)))
         return tuple(out)
 
     def get_question(self, question_char_idxs, question_glove_idxs, question_word_idxs, question_elmo_idxs=None,
-                     **kwargs):
-        mq = ((question_glove_idxs == 0).float() * -1e9)
-        q = self.question_embedding(question_char_idxs, question_glove_idxs, question_word_idxs, ex=question_elmo_idxs)
-        qd1 = self.question_start(q, mq)
-        q1 = qd1['dense']
-        qd2 = self.question_end(q, mq)
-        q2 = qd2['dense']
-        out = list(torch.cat([q1, q2], 1).unsqueeze(1))
+                     question_elmo_reps=None, **kwargs):
+        q = self.encode_question(question_char_idxs, question_glove_idxs, question_word_idxs,
+                                 question_elmo_idxs=question_elmo_idxs, question_elmo_reps=question_elmo_reps)
+        out = [self._sparsify(each) for each in q.unsqueeze(1)]
         return out
 
+    def encode_context(self, context_char_idxs, context_glove_idxs, context_word_idxs, context_elmo_idxs=None,
+                       context_elmo_reps=None):
+        """Returns start and end vectors of each context word, i.e. [B, L, d/2] each."""
+        x1, x2, _ = self._encode_context(context_char_idxs, context_glove_idxs, context_word_idxs,
+                                         context_elmo_idxs=context_elmo_idxs, context_elmo_reps=context_elmo_reps)
+        return x1, x2
+
+    def encode_question(self, question_char_idxs, question_glove_idxs, question_word_idxs, question_elmo_idxs=None,
+                        question_elmo_reps=None):
+        """Returns the question vectors, i.e. [B, d]."""
+        mq = ((question_glove_idxs == 0).float() * -1e9)
+        q = self.question_embedding(question_char_idxs, question_glove_idxs, question_word_idxs, ex=question_elmo_idxs,
+                                    er=question_elmo_reps)
+        qd1, qd2 = self._boundaries(self.question_start, self.question_end, q, mq)
+        return torch.cat([qd1['dense'], qd2['dense']], 1)
+
+    def export(self):
+        """Traces `encode_question` and `encode_context` into TorchScript modules, which only take (char, glove, word)
+        idxs and can be served without this code base.
+        """
+        assert not self.embedding.use_elmo, 'Models with ELMo cannot be exported.'
+        # packed sequences and chunked attention depend on input sizes, so they cannot be traced
+        options = tuple((module, name, getattr(module, name)) for module in self.modules()
+                        for name in ('packed', 'fused', 'chunk_size') if hasattr(module, name))
+        for module, name, _ in options:
+            setattr(module, name, 0 if name == 'chunk_size' else False)
+        self.eval()
+        dummy = (torch.ones(2, 5, 4, dtype=torch.int64), torch.ones(2, 5, dtype=torch.int64),
+                 torch.ones(2, 5, dtype=torch.int64))
+        try:
+            with torch.no_grad():
+                question = torch.jit.trace(_Encoder(self, 'encode_question', ('question_embedding', 'question_start',
+                                                                              'question_end')), dummy)
+                context = torch.jit.trace(_Encoder(self, 'encode_context', ('context_embedding', 'context_start',
+                                                                            'context_end')), dummy)
+        finally:
+            for module, name, value in options:
+                setattr(module, name, value)
+        return {'question': question, 'context': context}
+
+    def quantize(self):
+        """Dynamic int8 quantization of the LSTMs and linear layers of the question encoder, for CPU inference.
+
+        The question encoder gets its own copy of the embedding with quantized highway layers, so that the context
+        encoder (which shares the embedding) stays in float32. Other submodules of the embedding (e.g. GloVe) are
+        still shared rather than copied.
+        """
+        from torch.quantization import quantize_dynamic
+        for name in ('question_start', 'question_end'):
+            setattr(self, name, quantize_dynamic(getattr(self, name), {nn.LSTM, nn.Linear}, dtype=torch.qint8))
+        embedding = copy.copy(self.question_embedding)
+        embedding._modules = OrderedDict(self.question_embedding._modules)
+        for name in ('highway1', 'highway2'):
+            # `quantize_dynamic` returns a quantized copy and leaves the original highway as is
+            embedding._modules[name] = quantize_dynamic(getattr(embedding, name), {nn.Linear}, dtype=torch.qint8)
+        self.question_embedding = embedding
+        return self
+
+    def get_elmo(self, elmo_idxs):
+        return self.embedding.get_elmo(elmo_idxs)
+
+    def _encode_context(self, context_char_idxs, context_glove_idxs, context_word_idxs, context_elmo_idxs=None,
+                        context_elmo_reps=None):
+        mx = (context_glove_idxs == 0).float() * -1e9
+        x = self.context_embedding(context_char_idxs, context_glove_idxs, context_word_idxs, ex=context_elmo_idxs,
+                                   er=context_elmo_reps)
+        xd1, xd2 = self._boundaries(self.context_start, self.context_end, x, mx)
+        return xd1['dense'], xd2['dense'], x
+
+    def _filter_phrases(self, pos_list, probs):
+        """Keeps the phrases whose start probability times end probability (from `self.linear`) is at least
+        `filter_th`, at most the `filter_top_n` most probable ones, and at least the most probable one, in order.
+        """
+        probs = probs.cpu()
+        scores = probs[[i for i, _ in pos_list]] * probs[[j for _, j in pos_list]]
+        order = scores.argsort(descending=True)
+        keep = order[scores[order] >= self.filter_th]
+        if self.filter_top_n > 0:
+            keep = keep[:self.filter_top_n]
+        if len(keep) == 0:
+            keep = order[:1]
+        return [pos_list[idx] for idx in sorted(keep.tolist())]
+
+    def _sparsify(self, dense):
+        """Keeps the `sparse_k` largest magnitudes of each row of `dense` as a `SparseTensor` (if `sparse_k` > 0)."""
+        if self.sparse_k <= 0:
+            return dense
+        _, idx = dense.abs().topk(min(self.sparse_k, dense.size(1)), 1)
+        return SparseTensor(idx, dense.gather(1, idx), max_=dense.size(1))
+
+    def _boundaries(self, start, end, x, m):
+        if not self.fused:
+            return start(x, m), end(x, m)
+        if (start, end) not in self._fused_lstms:
+            self._fused_lstms[start, end] = _FusedLSTM((start, end))
+        fused = self._fused_lstms[start, end]
+        x = torch.cat([start.dropout(x), end.dropout(x)], 2) if self.training else x
+        x1, x2 = fused.split(_run_lstm(fused.get(training=self.training), x, m, packed=self.packed))
+        return start.attend(x1, m), end.attend(x2, m)
+
 
 class Loss(base.Loss):
-    def __init__(self, **kwargs):
+    def __init__(self, filter_weight=0.0, **kwargs):
         super(Loss, self).__init__()
         self.cel = nn.CrossEntropyLoss()
+        self.filter_weight = filter_weight
 
-    def forward(self, logits1, logits2, answer_word_starts, answer_word_ends, **kwargs):
+    def forward(self, logits1, logits2, answer_word_starts, answer_word_ends, filter_logits=None,
+                context_glove_idxs=None, **kwargs):
         answer_word_starts -= 1
         answer_word_ends -= 1
         loss1 = self.cel(logits1, answer_word_starts[:, 0])
         loss2 = self.cel(logits2, answer_word_ends[:, 0])
         loss = loss1 + loss2
+        if self.filter_weight > 0:
+            # answer start and end words are the positives of the question-independent phrase filter
+            target = torch.zeros_like(filter_logits)
+            target.scatter_(1, answer_word_starts[:, :1], 1.0)
+            target.scatter_(1, answer_word_ends[:, :1], 1.0)
+            mask = (context_glove_idxs > 0).float()
+            loss_filter = nn.functional.binary_cross_entropy_with_logits(filter_logits, target, reduction='none')
+            loss = loss + self.filter_weight * (loss_filter * mask).sum() / mask.sum()
         return loss
+
+
+def _run_lstm(lstm, x, m, packed=False):
+    """Runs a batch-first `lstm` over `x` and returns its output sequence.
+
+    If `packed`, the lengths are derived from the additive mask `m` (0 for tokens, -1e9 for pads) and the LSTM only
+    runs over the actual tokens; outputs at pad positions are zeros instead of values computed from pads.
+    """
+    if not packed:
+        out, _ = lstm(x)
+        return out
+    lengths = (m == 0).long().sum(1).clamp(min=1)
+    sorted_lengths, perm = lengths.sort(0, descending=True)
+    _, unperm = perm.sort(0)
+    packed_x = pack_padded_sequence(x.index_select(0, perm), sorted_lengths.tolist(), batch_first=True)
+    packed_out, _ = lstm(packed_x)
+    out, _ = pad_packed_sequence(packed_out, batch_first=True, total_length=x.size(1))
+    return out.index_select(0, unperm)
+
+
+def _lstm(input_, weights, num_layers):
+    """A batch-first, bidirectional LSTM over a tensor or `PackedSequence`, with `weights` given as tensors (in the
+    order of `nn.LSTM`'s parameters) rather than parameters, and zero initial states. Returns (output, (h_n, c_n)).
+
+    This is the computation of `nn.LSTM.forward` (`torch._VF.lstm`) without the module, so that the weights can be
+    built from other parameters and gradients flow back to them.
+    """
+    data = input_.data if isinstance(input_, PackedSequence) else input_
+    batch_size = int(input_.batch_sizes[0]) if isinstance(input_, PackedSequence) else input_.size(0)
+    hx = data.new_zeros(2 * num_layers, batch_size, weights[1].size(1))
+    if isinstance(input_, PackedSequence):
+        out, h_n, c_n = torch._VF.lstm(data, input_.batch_sizes, (hx, hx), weights, True, num_layers, 0.0, True, True)
+        return PackedSequence(out, input_.batch_sizes), (h_n, c_n)
+    out, h_n, c_n = torch._VF.lstm(data, (hx, hx), weights, True, num_layers, 0.0, True, True, True)
+    return out, (h_n, c_n)
+
+
+class _Encoder(nn.Module):
+    """Wraps an encoding method of `Model` for tracing, keeping only the submodules it needs."""
+    def __init__(self, model, method, module_names):
+        super(_Encoder, self).__init__()
+        self.model = copy.copy(model)
+        self.model._modules = OrderedDict((name, model._modules[name]) for name in module_names)
+        self.method = method
+
+    def forward(self, char_idxs, glove_idxs, word_idxs):
+        return getattr(self.model, self.method)(char_idxs, glove_idxs, word_idxs)
+
+
+class _FusedLSTM(object):
+    """Runs the LSTM stacks of several boundaries (with the same configuration) as a single, wider LSTM.
+
+    The weights of the fused LSTM are built from the boundaries' own parameters: gates of the stacks are interleaved
+    and the recurrent (and, for deeper layers, input) weights are block-diagonal, so that each stack only sees its own
+    states. Hence the outputs are identical to running the stacks one by one and checkpoints are shared. During
+    training the input is the concatenation of each stack's (dropped-out) input; otherwise dropout is the identity and
+    a single input is shared by all stacks. With gradients (or in training), the weights are rebuilt on each forward
+    so that gradients flow to the boundaries (see `_lstm`); otherwise they are copied into the parameters of an
+    `nn.LSTM` only when the boundaries' parameters change.
+    """
+    def __init__(self, boundaries):
+        self.boundaries = boundaries
+        self.num_stacks = len(boundaries)
+        self.num_layers = boundaries[0].num_layers
+        self.hidden_size = boundaries[0].hidden_size
+        assert all(b.num_layers == self.num_layers and b.hidden_size == self.hidden_size for b in boundaries)
+        self._lstms = {}  # (device, dtype) -> nn.LSTM holding the fused weights for a shared input
+        self._versions = {}  # same key -> (data pointer, version) of each parameter the weights were copied from
+
+    def get(self, training=False):
+        """A batch-first LSTM module (or function) for the current parameters, whose input is shared by all stacks if
+        not `training`.
+        """
+        if training or torch.is_grad_enabled():
+            weights = self._build(shared_input=not training)
+            return lambda input_: _lstm(input_, weights, self.num_layers)
+        params = self._params()
+        key = (params[0].device, params[0].dtype)
+        if key not in self._lstms:
+            self._lstms[key] = nn.LSTM(input_size=params[0].size(1), hidden_size=self.hidden_size * self.num_stacks,
+                                       num_layers=self.num_layers, batch_first=True,
+                                       bidirectional=True).to(params[0]).eval()
+        lstm = self._lstms[key]
+        versions = [(param.data_ptr(), param._version) for param in params]
+        if self._versions.get(key) != versions:
+            with torch.no_grad():
+                for name, weight in zip(self._names(), self._build(shared_input=True)):
+                    getattr(lstm, name).copy_(weight)
+            lstm.flatten_parameters()
+            self._versions[key] = versions
+        return lstm
+
+    def _params(self):
+        return [param for b in self.boundaries for i in range(self.num_layers)
+                for param in dict(b.named_children())['lstm%d' % i].parameters()]
+
+    def _names(self):
+        """Parameter names of the fused `nn.LSTM`, in the order of `_build`."""
+        return ['%s_l%d%s' % (name, i, suffix) for i in range(self.num_layers) for suffix in ('', '_reverse')
+                for name in ('weight_ih', 'weight_hh', 'bias_ih', 'bias_hh')]
+
+    def _build(self, shared_input):
+        """The fused weights of each layer and direction: input and hidden weights, then input and hidden biases."""
+        weights = []
+        for i in range(self.num_layers):
+            lstms = [dict(b.named_children())['lstm%d' % i] for b in self.boundaries]
+            for suffix in ('_l0', '_l0_reverse'):
+                params = [[getattr(lstm, name + suffix) for lstm in lstms]
+                          for name in ('weight_ih', 'weight_hh', 'bias_ih', 'bias_hh')]
+                weights.extend([self._fuse(params[0], 'input' if i == 0 else 'output', shared_input=shared_input),
+                                self._fuse(params[1], 'hidden'), self._fuse(params[2]), self._fuse(params[3])])
+        return weights
+
+    def split(self, output):
+        """Splits the fused (bidirectional) output into the outputs of each stack."""
+        h, n = self.hidden_size, self.num_stacks
+        return tuple(torch.cat([output[..., s * h:(s + 1) * h], output[..., (n + s) * h:(n + s + 1) * h]], -1)
+                     for s in range(n))
+
+    def _fuse(self, params, cols=None, shared_input=False):
+        """Fuses per-stack [4h, *] params, where `cols` is the layout of the columns of the fused param.
+
+        `cols` is 'input' (concatenated or shared inputs), 'hidden' (concatenated hidden states), 'output'
+        (bidirectional output of the previous fused layer), or None for biases.
+        """
+        h, n = self.hidden_size, self.num_stacks
+        if cols is None:
+            return torch.cat([param.view(4, 1, h) for param in params], 1).view(-1)
+        if cols == 'input' and shared_input:
+            return torch.cat([param.view(4, 1, h, -1) for param in params], 1).view(4 * n * h, -1)
+        in_size = params[0].size(1)
+        out = params[0].new_zeros(4, n, h, n * in_size)
+        for s, param in enumerate(params):
+            param = param.view(4, h, in_size)
+            if cols == 'output':
+                out[:, s, :, s * h:(s + 1) * h] = param[:, :, :h]
+                out[:, s, :, (n + s) * h:(n + s + 1) * h] = param[:, :, h:]
+            else:
+                out[:, s, :, s * in_size:(s + 1) * in_size] = param
+        return out.view(4 * n * h, n * in_size)
+
+
+def _chunked_attention(query, key, value, mask, chunk_size):
+    """Equivalent to `softmax(query * key^T + mask) * value`, without materializing the [B, L, L] attention.
+
+    Query blocks are attended one at a time, each with a running max and normalizer over key blocks (online softmax),
+    so the largest intermediate is [B, chunk_size, chunk_size]. During training each query block is recomputed in the
+    backward pass instead of being stored.
+    """
+    outputs = []
+    for i in range(0, query.size(1), chunk_size):
+        query_block = query[:, i:i + chunk_size]
+        if torch.is_grad_enabled() and query_block.requires_grad:
+            output = checkpoint(_attend_block, query_block, key, value, mask, chunk_size, use_reentrant=False)
+        else:
+            output = _attend_block(query_block, key, value, mask, chunk_size)
+        outputs.append(output)
+    return torch.cat(outputs, 1)
+
+
+def _attend_block(query, key, value, mask, chunk_size):
+    max_, norm, acc = None, None, None
+    for j in range(0, key.size(1), chunk_size):
+        logits = query.matmul(key[:, j:j + chunk_size].transpose(1, 2)) + mask[:, j:j + chunk_size].unsqueeze(1)
+        block_max = logits.max(2, keepdim=True)[0]
+        if max_ is None:
+            max_ = block_max
+            weights = (logits - max_).exp()
+            norm = weights.sum(2, keepdim=True)
+            acc = weights.matmul(value[:, j:j + chunk_size])
+        else:
+            new_max = torch.max(max_, block_max)
+            scale = (max_ - new_max).exp()
+            weights = (logits - new_max).exp()
+            norm = norm * scale + weights.sum(2, keepdim=True)
+            acc = acc * scale + weights.matmul(value[:, j:j + chunk_size])
+            max_ = new_max
+    return acc / norm
@@ -1,12 +1,16 @@
+import copy
+import hashlib
+import json
+import os
 import random
 import re
 import string
-from collections import Counter
+from collections import Counter, OrderedDict
 
 import nltk
 import torch
 import torch.utils.data
-from scipy.sparse import csc_matrix
+from scipy.sparse import csr_matrix
 import numpy as np
 
 import base
@@ -54,22 +58,25 @@ class Processor(base.Processor):
     unk = '<unk>'
 
     def __init__(self, char_vocab_size=None, glove_vocab_size=None, word_vocab_size=None, elmo=False, draft=False,
-                 emb_type=None, **kwargs):
+                 emb_type=None, elmo_cache_dir=None, phrase_strings=False, **kwargs):
         self._word_tokenizer = PTBWordTokenizer()
         self._sent_tokenizer = PTBSentTokenizer()
         self._char_vocab_size = char_vocab_size
         self._glove_vocab_size = glove_vocab_size
         self._word_vocab_size = word_vocab_size
         self._elmo = elmo
-        if elmo:
+        self._elmo_cache_dir = elmo_cache_dir
+        if elmo and elmo_cache_dir is None:
             from allennlp.modules.elmo import batch_to_ids
             self._batch_to_ids = batch_to_ids
         self._draft = draft
         self._emb_type = emb_type
+        self._phrase_strings = phrase_strings
         self._glove = None
 
         self._word_cache = {}
         self._sent_cache = {}
+        self._window_buffer = {}
         self._word2idx_dict = {}
         self._word2idx_ext_dict = {}
         self._char2idx_dict = {}
@@ -104,9 +111,9 @@ class Processor(base.Processor):
         # assert max(self._word2idx_ext.values()) + 1 == self._glove_vocab_size, max(self._word2idx_ext.values()) + 1
 
     def state_dict(self):
-        out = {'word2idx': self._word2idx,
-               'word2idx_ext': self._word2idx_ext,
-               'char2idx': self._char2idx}
+        out = {'word2idx': self._word2idx_dict,
+               'word2idx_ext': self._word2idx_ext_dict,
+               'char2idx': self._char2idx_dict}
         return out
 
     def load_state_dict(self, in_):
@@ -179,39 +186,94 @@ class Processor(base.Processor):
         return out
 
     def postprocess_batch(self, dataset, model_input, model_output):
+        # Copy the predictions and indices at once, instead of a device sync per example
+        model_output = dict(model_output, yp1=model_output['yp1'].cpu(), yp2=model_output['yp2'].cpu())
         results = tuple(self.postprocess(dataset[idx],
                                          {key: val[i] if val is not None else None for key, val in
                                           model_output.items()})
-                        for i, idx in enumerate(model_input['idx']))
+                        for i, idx in enumerate(model_input['idx'].tolist()))
         return results
 
     def postprocess_context(self, example, context_output):
         pos_tuple, dense = context_output
-        out = dense.cpu().numpy()
+        out = _to_numpy(dense)
         context = example['context']
         context_spans = example['context_spans']
-        phrases = tuple(_get_pred(context, context_spans, yp1, yp2) for yp1, yp2 in pos_tuple)
-        if self._emb_type == 'sparse':
-            out = csc_matrix(out)
-        return example['cid'], phrases, out
+        offsets = tuple(_get_offsets(context_spans, yp1, yp2) for yp1, yp2 in pos_tuple)
+        return example['cid'], self._to_phrases(context, offsets), self._to_emb(out)
 
     def postprocess_context_batch(self, dataset, model_input, context_output):
         results = tuple(self.postprocess_context(dataset[idx], context_output[i])
                         for i, idx in enumerate(model_input['idx']))
         return results
 
+    def postprocess_context_window(self, example, context_output):
+        """Merges a window's phrases into its document, and returns the document's output once all windows are in.
+
+        A phrase appearing in several (overlapping) windows is kept from the window in which it has the most
+        surrounding words, i.e. the largest `min(left, right)` context.
+        """
+        pos_tuple, dense = context_output
+        buffer = self._window_buffer.setdefault(example['cid'], {'count': 0, 'best': {}, 'mats': []})
+        window_idx = len(buffer['mats'])
+        buffer['mats'].append(_to_numpy(dense))
+        window_len = len(example['context_spans'])
+        for k, (yp1, yp2) in enumerate(pos_tuple):
+            pos = (example['window_start'] + yp1, example['window_start'] + yp2)
+            score = min(yp1, window_len - 1 - yp2)
+            if pos not in buffer['best'] or score > buffer['best'][pos][0]:
+                offset = _get_offsets(example['context_spans'], yp1, yp2)
+                buffer['best'][pos] = (score, window_idx, k, offset)
+        buffer['count'] += 1
+        if buffer['count'] < example['num_windows']:
+            return None
+
+        del self._window_buffer[example['cid']]
+        best = tuple(buffer['best'][pos] for pos in sorted(buffer['best']))
+        phrases = self._to_phrases(example['context'], tuple(offset for _, _, _, offset in best))
+        mats = buffer['mats']
+        if isinstance(mats[0], SparseTensor):
+            out = SparseTensor(np.stack([mats[window_idx].idx[k] for _, window_idx, k, _ in best], 0),
+                               np.stack([mats[window_idx].val[k] for _, window_idx, k, _ in best], 0),
+                               max_=mats[0].max)
+        else:
+            out = np.stack([mats[window_idx][k] for _, window_idx, k, _ in best], 0)
+        return example['cid'], phrases, self._to_emb(out)
+
+    def postprocess_context_window_batch(self, dataset, model_input, context_output):
+        results = tuple(self.postprocess_context_window(dataset[idx], context_output[i])
+                        for i, idx in enumerate(model_input['idx']))
+        return tuple(result for result in results if result is not None)
+
     def postprocess_question(self, example, question_output):
         dense = question_output
-        out = dense.cpu().numpy()
-        if self._emb_type == 'sparse':
-            out = csc_matrix(out)
-        return example['id'], out
+        out = _to_numpy(dense)
+        return example['id'], self._to_emb(out)
 
     def postprocess_question_batch(self, dataset, model_input, question_output):
         results = tuple(self.postprocess_question(dataset[idx], question_output[i])
                         for i, idx in enumerate(model_input['idx']))
         return results
 
+    def window(self, example, window_size, stride):
+        """Splits a preprocessed context example into overlapping windows of at most `window_size` words.
+
+        Each window keeps the full `context`, and its `context_spans` are still character offsets into it.
+        """
+        num_words = len(example['context_spans'])
+        starts = [0]
+        while starts[-1] + window_size < num_words:
+            starts.append(starts[-1] + stride)
+        windows = []
+        for start in starts:
+            window = dict(example)
+            for key in ('context_spans', 'context_word_idxs', 'context_glove_idxs', 'context_char_idxs'):
+                window[key] = example[key][start:start + window_size]
+            window['window_start'] = start
+            window['num_windows'] = len(starts)
+            windows.append(window)
+        return tuple(windows)
+
     def collate(self, examples):
         tensors = {}
         for key in self.keys:
@@ -224,18 +286,34 @@ class Processor(base.Processor):
             _fill_tensor(tensor, val)
             tensors[key] = tensor
         if self._elmo:
-            if 'context' in examples[0]:
-                sentences = [[example['context'][span[0]:span[1]] for span in example['context_spans']]
-                             for example in examples]
-                character_ids = self._batch_to_ids(sentences)
-                tensors['context_elmo_idxs'] = character_ids
-            if 'question' in examples[0]:
-                sentences = [[example['question'][span[0]:span[1]] for span in example['question_spans']]
-                             for example in examples]
-                character_ids = self._batch_to_ids(sentences)
-                tensors['question_elmo_idxs'] = character_ids
+            for key in ('context', 'question'):
+                if key not in examples[0]:
+                    continue
+                if self._elmo_cache_dir is None:
+                    sentences = [[example[key][span[0]:span[1]] for span in example['%s_spans' % key]]
+                                 for example in examples]
+                    tensors['%s_elmo_idxs' % key] = self.collate_elmo(sentences)
+                else:
+                    store = ElmoStore.open(self._elmo_cache_dir)
+                    reps = [store.get(example[key], start=example.get('window_start', 0) if key == 'context' else 0,
+                                      length=len(example['%s_spans' % key]))
+                            for example in examples]
+                    tensors['%s_elmo_reps' % key] = _pad_reps(reps)
         return tensors
 
+    def collate_elmo(self, sentences):
+        return self._batch_to_ids(sentences)
+
+    def elmo_sentences(self, examples):
+        """Returns the tokens of each unique context and question of `examples`, keyed by text."""
+        sentences = OrderedDict()
+        for example in examples:
+            for key in ('context', 'question'):
+                if key in example and example[key] not in sentences:
+                    text = example[key]
+                    sentences[text] = tuple(text[span[0]:span[1]] for span in self._word_tokenize(text))
+        return sentences
+
     def process_metadata(self, metadata):
         return {'glove_emb_mat': torch.tensor(metadata['glove_emb_mat']),
                 'elmo_options_file': metadata['elmo_options_file'],
@@ -258,6 +336,19 @@ class Processor(base.Processor):
         return dump
 
     # private methods below
+    def _to_phrases(self, context, offsets):
+        """Phrase strings, or (by default) the context with the [N, 2] character offsets of its phrases."""
+        if self._phrase_strings:
+            return tuple(context[start:end] for start, end in offsets)
+        return {'context': context, 'spans': np.array(offsets, dtype=np.int32).reshape(-1, 2)}
+
+    def _to_emb(self, out):
+        if isinstance(out, SparseTensor):
+            return out.scipy()
+        if self._emb_type == 'sparse':
+            return csr_matrix(out)
+        return out
+
     def _word_tokenize(self, string):
         if string in self._word_cache:
             return self._word_cache[string]
@@ -318,33 +409,113 @@ class Sampler(base.Sampler):
     def __len__(self):
         return len(self._idxs)
 
+    def shard(self, rank, num_procs):
+        """Returns a copy that only yields every `num_procs`-th index (of the shuffled/bucketed order) from `rank`.
+
+        Shards have equal lengths, so that all processes of distributed training run the same number of steps.
+        """
+        sampler = copy.copy(self)
+        idxs = self._idxs[:len(self._idxs) - len(self._idxs) % num_procs]
+        sampler._idxs = idxs[rank::num_procs]
+        return sampler
+
 
 class SparseTensor(object):
+    """Rows with the same number of non-zeros, as their column indices `idx` and values `val` (both [N, k]).
+    """
     def __init__(self, idx, val, max_=None):
         self.idx = idx
         self.val = val
         self.max = max_
 
+    def numpy(self):
+        return SparseTensor(self.idx.cpu().numpy(), self.val.cpu().numpy(), max_=self.max)
+
     def scipy(self):
-        col = self.idx.flatten()
-        row = np.tile(np.expand_dims(range(self.idx.shape[0]), 1), [1, self.idx.shape[1]]).flatten()
-        data = self.val.flatten()
-        shape = None if self.max is None else [self.idx.shape[0], self.max]
-        return csc_matrix((data, (row, col)), shape=shape)
+        """CSR matrix built directly from the indices (every row has `k` entries), with sorted indices."""
+        num_rows, k = self.idx.shape
+        indptr = np.arange(0, num_rows * k + 1, k)
+        max_ = self.idx.max() + 1 if self.max is None else self.max
+        out = csr_matrix((self.val.flatten(), self.idx.flatten(), indptr), shape=[num_rows, max_])
+        out.sort_indices()
+        return out
+
+
+class ElmoStore(object):
+    """Memory-mapped store of precomputed ELMo biLM activations, one [num_tokens, num_layers, dim] array per text.
+
+    `reps.npy` holds the arrays of all texts concatenated along the first (token) axis, and `index.json` maps the md5 of
+    each text to its (offset, num_tokens) in `reps.npy`. Opened stores are shared within a process.
+    """
+    _stores = {}
+
+    def __init__(self, dirname, reps, index):
+        self.dirname = dirname
+        self.reps = reps
+        self.index = index
+
+    @classmethod
+    def open(cls, dirname):
+        if dirname not in cls._stores:
+            with open(os.path.join(dirname, 'index.json'), 'r') as fp:
+                index = json.load(fp)
+            reps = np.load(os.path.join(dirname, 'reps.npy'), mmap_mode='r')
+            assert reps.ndim == 3, '%s holds mixed ELMo representations; rerun `--mode cache_elmo`.' % dirname
+            cls._stores[dirname] = cls(dirname, reps, index)
+        return cls._stores[dirname]
+
+    @classmethod
+    def create(cls, dirname, lengths, num_layers=3, dim=1024):
+        """Allocates a store for texts with the given numbers of tokens (`lengths` maps text to num_tokens)."""
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        index, offset = {}, 0
+        for text, length in lengths.items():
+            index[cls.key(text)] = (offset, length)
+            offset += length
+        reps = np.lib.format.open_memmap(os.path.join(dirname, 'reps.npy'), mode='w+', dtype=np.float32,
+                                         shape=(offset, num_layers, dim))
+        return cls(dirname, reps, index)
+
+    @staticmethod
+    def key(text):
+        return hashlib.md5(text.encode('utf-8')).hexdigest()
+
+    def get(self, text, start=0, length=None):
+        offset, num_tokens = self.index[self.key(text)]
+        length = num_tokens - start if length is None else length
+        return self.reps[offset + start:offset + start + length]
+
+    def put(self, text, rep):
+        offset, num_tokens = self.index[self.key(text)]
+        assert rep.shape[0] == num_tokens, (rep.shape, num_tokens)
+        self.reps[offset:offset + num_tokens] = rep
+
+    def close(self):
+        self.reps.flush()
+        with open(os.path.join(self.dirname, 'index.json'), 'w') as fp:
+            json.dump(self.index, fp)
 
 
 # SquadProcessor-specific helpers
 
+def _to_numpy(output):
+    return output.numpy() if isinstance(output, SparseTensor) else output.cpu().numpy()
+
+
 def _get_pred(context, spans, yp1, yp2):
+    start, end = _get_offsets(spans, yp1, yp2)
+    return context[start:end]
+
+
+def _get_offsets(spans, yp1, yp2):
     if yp1 >= len(spans):
         print('warning: yp1 is set to 0')
         yp1 = 0
     if yp2 >= len(spans):
         print('warning: yp1 is set to 0')
         yp2 = 0
-    yp1c = spans[yp1][0]
-    yp2c = spans[yp2][1]
-    return context[yp1c:yp2c]
+    return spans[yp1][0], spans[yp2][1]
 
 
 def _get_spans(in_, tokens):
@@ -359,6 +530,13 @@ def _get_spans(in_, tokens):
     return tuple(pairs)
 
 
+def _pad_reps(reps):
+    out = torch.zeros((len(reps), max(rep.shape[0] for rep in reps)) + reps[0].shape[1:])
+    for i, rep in enumerate(reps):
+        out[i, :rep.shape[0]] = torch.from_numpy(np.array(rep))
+    return out
+
+
 def _get_shape(nested_list, depth):
     if depth > 0:
         return (len(nested_list),) + tuple(map(max, zip(*[_get_shape(each, depth - 1) for each in nested_list])))
@@ -1,6 +1,6 @@
 #!/usr/bin/env bash
-# Install requirements; assuming Python 3.6
-pip install nltk==3.3 numpy==1.15.2 scipy==1.1.0 torch==0.4.1 allennlp==0.6.1 tqdm gensim
+# Install requirements; assuming Python 3.7
+pip install nltk==3.3 numpy==1.15.2 scipy==1.1.0 torch==1.11.0 allennlp==0.6.1 tqdm
 
 DATA_DIR=$HOME/data/
 mkdir $DATA_DIR
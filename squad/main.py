@@ -1,3 +1,8 @@
+import contextlib
+import copy
+import os
+import queue
+import resource
 import sys
 import time
 from collections import OrderedDict
@@ -5,45 +10,51 @@ from pprint import pprint
 import importlib
 
 import torch
+import torch.distributed as dist
 import numpy as np
 from torch.utils.data import DataLoader
 
 import base
+from piqa_index import PhraseIndex
 
 
-def preprocess(interface, args):
+def preprocess(interface, args, timer=None):
     """Helper function for caching preprocessed data
     """
-    print('Loading train and dev data')
-    train_examples = interface.load_train()
-    dev_examples = interface.load_test()
-
-    # load metadata, such as GloVe
-    print('Loading metadata')
-    metadata = interface.load_metadata()
-
-    print('Constructing processor')
-    processor = Processor(**args.__dict__)
-    processor.construct(train_examples, metadata)
-
-    # data loader
-    print('Preprocessing datasets and metadata')
-    train_dataset = tuple(processor.preprocess(example) for example in train_examples)
-    dev_dataset = tuple(processor.preprocess(example) for example in dev_examples)
-    processed_metadata = processor.process_metadata(metadata)
+    timer = StageTimer() if timer is None else timer
+    with timer.stage('load'):
+        print('Loading train and dev data')
+        train_examples = interface.load_train()
+        dev_examples = interface.load_test()
+
+        # load metadata, such as GloVe
+        print('Loading metadata')
+        metadata = interface.load_metadata()
+
+    with timer.stage('preprocess'):
+        print('Constructing processor')
+        processor = Processor(**args.__dict__)
+        processor.construct(train_examples, metadata)
+
+        # data loader
+        print('Preprocessing datasets and metadata')
+        train_dataset = tuple(processor.preprocess(example) for example in train_examples)
+        dev_dataset = tuple(processor.preprocess(example) for example in dev_examples)
+        processed_metadata = processor.process_metadata(metadata)
 
     print('Creating data loaders')
     train_sampler = Sampler(train_dataset, 'train', **args.__dict__)
-    train_loader = DataLoader(train_dataset, batch_size=args.batch_size,
-                              collate_fn=processor.collate, sampler=train_sampler)
+    train_loader = DataLoader(train_dataset, batch_size=args.batch_size, collate_fn=processor.collate,
+                              sampler=train_sampler, num_workers=args.num_workers, pin_memory=args.cuda)
 
     dev_sampler = Sampler(dev_dataset, 'dev', **args.__dict__)
-    dev_loader = DataLoader(dev_dataset, batch_size=args.batch_size,
-                            collate_fn=processor.collate, sampler=dev_sampler)
+    dev_loader = DataLoader(dev_dataset, batch_size=args.batch_size, collate_fn=processor.collate,
+                            sampler=dev_sampler, num_workers=args.num_workers, pin_memory=args.cuda)
 
     if args.preload:
-        train_loader = tuple(train_loader)
-        dev_loader = tuple(dev_loader)
+        with timer.stage('collate'):
+            train_loader = tuple(train_loader)
+            dev_loader = tuple(dev_loader)
 
     out = {'processor': processor,
            'train_dataset': train_dataset,
@@ -55,24 +66,193 @@ def preprocess(interface, args):
     return out
 
 
-def train(args):
+class StageTimer(object):
+    """Opt-in timing of the stages of a run (e.g. `forward`, `backward`), and its example and token throughput.
+
+    When timing on GPU, each stage synchronizes the device, so that asynchronous kernels are attributed to the stage
+    that launched them. When disabled, `stage` and `count` do nothing.
+    """
+
+    def __init__(self, device=None, enabled=False):
+        self.device = device
+        self.enabled = enabled
+        self.times = OrderedDict()
+        self.num_examples = 0
+        self.num_tokens = 0
+        self._start_time = None
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+        self._sync()
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self._sync()
+            self.times[name] = self.times.get(name, 0.0) + time.time() - start_time
+
+    def count(self, batch):
+        """Counts the examples and (context and question) tokens of a batch. Throughput is from the first batch."""
+        if not self.enabled:
+            return
+        if self._start_time is None:
+            self._start_time = time.time()
+        self.num_examples += batch['idx'].size(0)
+        self.num_tokens += sum(int((val > 0).sum()) for key, val in batch.items() if key.endswith('_glove_idxs'))
+
+    def summary(self):
+        if not self.enabled:
+            return OrderedDict()
+        out = OrderedDict(('%s_time' % name, duration) for name, duration in self.times.items())
+        duration = 0.0 if self._start_time is None else time.time() - self._start_time
+        out['examples_per_sec'] = self.num_examples / duration if duration > 0 else 0.0
+        out['tokens_per_sec'] = self.num_tokens / duration if duration > 0 else 0.0
+        out['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        if self.device is not None and self.device.type == 'cuda':
+            out['peak_device_mb'] = torch.cuda.max_memory_allocated(self.device) / 2 ** 20
+        return out
+
+    def _sync(self):
+        if self.device is not None and self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+
+
+def get_profiler(args, device):
+    """Returns a started `torch.profiler.profile` of `--profile_steps` steps from `--profile_start`, or None."""
+    if not args.profile:
+        return None
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if device.type == 'cuda':
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+    schedule = torch.profiler.schedule(wait=max(args.profile_start - 1, 0), warmup=min(args.profile_start, 1),
+                                       active=args.profile_steps, repeat=1)
+    profiler = torch.profiler.profile(activities=activities, schedule=schedule, record_shapes=True,
+                                      profile_memory=True,
+                                      on_trace_ready=torch.profiler.tensorboard_trace_handler(args.profile_dir))
+    profiler.start()
+    return profiler
+
+
+class Prefetcher(object):
+    """Iterates over the batches of `loader` on `device`, staging the next batch while the current one is used.
+
+    On GPU, the next batch is copied on a side stream (non-blocking, from pinned memory), so that the copy overlaps
+    with the computation of the current batch. `stall_time` accumulates the time spent waiting for the loader.
+    Collating and copying are timed as stages of `timer`, if given.
+    """
+
+    def __init__(self, loader, device, timer=None):
+        self.loader = loader
+        self.device = device
+        self.timer = StageTimer() if timer is None else timer
+        self.stall_time = 0.0
+        self._stream = torch.cuda.Stream() if device.type == 'cuda' else None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        iterator = iter(self.loader)
+        batch = self._next(iterator)
+        while batch is not None:
+            if self._stream is not None:
+                torch.cuda.current_stream().wait_stream(self._stream)
+                for val in batch.values():
+                    val.record_stream(torch.cuda.current_stream())
+            next_batch = self._next(iterator)
+            yield batch
+            batch = next_batch
+
+    def _next(self, iterator):
+        start_time = time.time()
+        with self.timer.stage('collate'):
+            batch = next(iterator, None)
+        self.stall_time += time.time() - start_time
+        if batch is None:
+            return None
+        with self.timer.stage('copy'):
+            if self._stream is None:
+                return {key: val.to(self.device) for key, val in batch.items()}
+            with torch.cuda.stream(self._stream):
+                return {key: val.to(self.device, non_blocking=True) for key, val in batch.items()}
+
+
+def shard_loader(loader, rank, num_procs):
+    """The part of `loader` (a `DataLoader`, or a tuple of batches with `--preload`) of one distributed process."""
+    if isinstance(loader, DataLoader):
+        return DataLoader(loader.dataset, batch_size=loader.batch_size, collate_fn=loader.collate_fn,
+                          sampler=loader.sampler.shard(rank, num_procs), num_workers=loader.num_workers,
+                          pin_memory=loader.pin_memory)
+    return loader[:len(loader) - len(loader) % num_procs][rank::num_procs]
+
+
+def broadcast_params(model):
+    for param in model.parameters():
+        if param.requires_grad:
+            dist.broadcast(param.data, 0)
+
+
+def all_reduce_grads(model, num_procs):
+    """Averages the gradients over the processes, with a single all-reduce of the flattened gradients."""
+    grads = [param.grad for param in model.parameters() if param.grad is not None]
+    flat = torch.cat([grad.view(-1) for grad in grads])
+    dist.all_reduce(flat)
+    flat /= num_procs
+    offset = 0
+    for grad in grads:
+        grad.copy_(flat[offset:offset + grad.numel()].view_as(grad))
+        offset += grad.numel()
+
+
+def train_distributed(args):
+    """Data-parallel training in `args.num_procs` processes, which share the preprocessed data of this process."""
+    interface = FileInterface(**args.__dict__)
+    out = interface.cache(preprocess, args) if args.cache else preprocess(interface, args)
+    torch.multiprocessing.start_processes(_train_process, args=(args, out), nprocs=args.num_procs,
+                                          start_method='fork')
+
+
+def _train_process(rank, args, out):
+    train(args, rank=rank, out=out)
+
+
+def train(args, rank=0, out=None):
     start_time = time.time()
     device = torch.device('cuda' if args.cuda else 'cpu')
+    distributed = args.num_procs > 1
 
-    pprint(args.__dict__)
+    if rank == 0:
+        pprint(args.__dict__)
+    timer = StageTimer(device, enabled=args.timing)
     interface = FileInterface(**args.__dict__)
-    out = interface.cache(preprocess, args) if args.cache else preprocess(interface, args)
+    if out is None:
+        if args.cache:
+            with timer.stage('load'):
+                out = interface.cache(preprocess, args)
+        else:
+            out = preprocess(interface, args, timer=timer)
     processor = out['processor']
     processed_metadata = out['processed_metadata']
     train_dataset = out['train_dataset']
     dev_dataset = out['dev_dataset']
     train_loader = out['train_loader']
-    dev_loader = out['dev_loader']
+    evaluator = AsyncEvaluator(args, out, device) if args.async_eval and rank == 0 else None
+    if distributed:
+        dist.init_process_group('gloo', init_method=args.dist_url, rank=rank, world_size=args.num_procs)
+        torch.set_num_threads(max(os.cpu_count() // args.num_procs, 1))
+        train_loader = shard_loader(train_loader, rank, args.num_procs)
+    train_loader = Prefetcher(train_loader, device, timer=timer)
+    dev_loader = Prefetcher(out['dev_loader'], device)
 
     model = Model(**args.__dict__).to(device)
     model.init(processed_metadata)
+    if distributed:
+        broadcast_params(model)
 
-    loss_model = Loss().to(device)
+    loss_model = Loss(**args.__dict__).to(device)
     optimizer = torch.optim.Adam(p for p in model.parameters() if p.requires_grad)
 
     interface.bind(processor, model, optimizer=optimizer)
@@ -81,149 +261,406 @@ def train(args):
     train_report, dev_report = None, None
 
     print('Training')
+    profiler = get_profiler(args, device) if rank == 0 else None
     model.train()
     for epoch_idx in range(args.epochs):
         for i, train_batch in enumerate(train_loader):
-            train_batch = {key: val.to(device) for key, val in train_batch.items()}
-            model_output = model(step=step, **train_batch)
-            train_results = processor.postprocess_batch(train_dataset, train_batch, model_output)
-            train_loss = loss_model(step=step, **model_output, **train_batch)
-            train_f1 = float(np.mean([result['f1'] for result in train_results]))
-            train_em = float(np.mean([result['em'] for result in train_results]))
+            timer.count(train_batch)
+            with timer.stage('forward'):
+                model_output = model(step=step, **train_batch)
+                train_loss = loss_model(step=step, **model_output, **train_batch)
 
             # optimize
-            optimizer.zero_grad()
-            train_loss.backward()
-            optimizer.step()
+            with timer.stage('backward'):
+                optimizer.zero_grad()
+                train_loss.backward()
+                if distributed:
+                    all_reduce_grads(model, args.num_procs)
+                optimizer.step()
             step += 1
 
-            # report & eval & save
-            if step % args.report_period == 1:
+            # report & eval & save (only from the first process in distributed training)
+            if rank == 0 and step % args.report_period == 1:
+                # Train metrics of the reported batch only, since postprocessing is slow (string-level F1 in Python)
+                with timer.stage('postprocess'):
+                    train_results = processor.postprocess_batch(train_dataset, train_batch, model_output)
+                    train_f1 = float(np.mean([result['f1'] for result in train_results]))
+                    train_em = float(np.mean([result['em'] for result in train_results]))
                 train_report = OrderedDict(step=step, train_loss=train_loss.item(), train_f1=train_f1,
-                                           train_em=train_em, time=time.time() - start_time)
-                print(interface.report(**train_report))
-
-            if step % args.eval_save_period == 1:
-                with torch.no_grad():
-                    model.eval()
-                    loss_model.eval()
-                    pred = {}
-                    dev_losses, dev_results = [], []
-                    for dev_batch, _ in zip(dev_loader, range(args.eval_steps)):
-                        dev_batch = {key: val.to(device) for key, val in dev_batch.items()}
-                        model_output = model(**dev_batch)
-                        results = processor.postprocess_batch(dev_dataset, dev_batch, model_output)
-
-                        dev_loss = loss_model(step=step, **dev_batch, **model_output)
-
-                        for result in results:
-                            pred[result['id']] = result['pred']
-                        dev_results.extend(results)
-                        dev_losses.append(dev_loss.item())
-
-                    dev_loss = float(np.mean(dev_losses))
-                    dev_f1 = float(np.mean([result['f1'] for result in dev_results]))
-                    dev_em = float(np.mean([result['em'] for result in dev_results]))
-                    dev_f1_best = dev_f1 if dev_report is None else max(dev_f1, dev_report['dev_f1_best'])
-                    dev_f1_best_step = step if dev_report is None or dev_f1 > dev_report['dev_f1_best'] else dev_report[
-                        'dev_f1_best_step']
-
-                    dev_report = OrderedDict(step=step, dev_loss=dev_loss, dev_f1=dev_f1, dev_em=dev_em,
-                                             time=time.time() - start_time, dev_f1_best=dev_f1_best,
-                                             dev_f1_best_step=dev_f1_best_step)
-
-                    summary = False
-                    if dev_report['dev_f1_best_step'] == step:
-                        summary = True
-                        interface.save(iteration=step)
-                        interface.pred(pred)
-                    print(interface.report(summary=summary, **dev_report))
+                                           train_em=train_em, time=time.time() - start_time,
+                                           input_stall=train_loader.stall_time)
+                train_report.update(timer.summary())
+                with timer.stage('write'):
+                    print(interface.report(**train_report))
+
+            if rank == 0 and step % args.eval_save_period == 1:
+                if evaluator is not None:
+                    evaluator.submit(step, model, optimizer)
+                else:
+                    with timer.stage('eval'):
+                        dev_out = evaluate(model, loss_model, processor, dev_dataset, dev_loader, step,
+                                           args.eval_steps)
+                    with timer.stage('write'):
+                        dev_report = report_dev(interface, dev_report, step, start_time, *dev_out,
+                                                save_all=args.keep_last > 0)
                     model.train()
                     loss_model.train()
 
+            if profiler is not None:
+                profiler.step()
+
+            if evaluator is not None:
+                for dev_step, save_kwargs, dev_out in evaluator.poll():
+                    dev_report = report_dev(interface, dev_report, dev_step, start_time, *dev_out,
+                                            save_all=args.keep_last > 0, **save_kwargs)
+
             if step == args.train_steps:
                 break
         if step == args.train_steps:
             break
+    if profiler is not None:
+        profiler.stop()
+    if evaluator is not None:
+        for dev_step, save_kwargs, dev_out in evaluator.poll(block=True):
+            dev_report = report_dev(interface, dev_report, dev_step, start_time, *dev_out,
+                                    save_all=args.keep_last > 0, **save_kwargs)
+        evaluator.close()
+    interface.flush()
+    if distributed:
+        dist.destroy_process_group()
+
+
+def evaluate(model, loss_model, processor, dev_dataset, dev_loader, step, eval_steps):
+    """Returns the dev loss, F1, EM and predictions of `model` on (up to) `eval_steps` dev batches."""
+    with torch.no_grad():
+        model.eval()
+        loss_model.eval()
+        pred = {}
+        dev_losses, dev_results = [], []
+        for dev_batch, _ in zip(dev_loader, range(eval_steps)):
+            model_output = model(**dev_batch)
+            results = processor.postprocess_batch(dev_dataset, dev_batch, model_output)
+
+            dev_loss = loss_model(step=step, **dev_batch, **model_output)
+
+            for result in results:
+                pred[result['id']] = result['pred']
+            dev_results.extend(results)
+            dev_losses.append(dev_loss.item())
+
+    dev_loss = float(np.mean(dev_losses))
+    dev_f1 = float(np.mean([result['f1'] for result in dev_results]))
+    dev_em = float(np.mean([result['em'] for result in dev_results]))
+    return dev_loss, dev_f1, dev_em, pred
+
+
+def report_dev(interface, dev_report, step, start_time, dev_loss, dev_f1, dev_em, pred, save_all=False,
+               **save_kwargs):
+    """Reports a dev evaluation, and saves the model (the current one, or the one in `save_kwargs`) if it is the best
+    (or always, with `save_all`).
+
+    Returns the new dev report.
+    """
+    dev_f1_best = dev_f1 if dev_report is None else max(dev_f1, dev_report['dev_f1_best'])
+    dev_f1_best_step = step if dev_report is None or dev_f1 > dev_report['dev_f1_best'] else dev_report[
+        'dev_f1_best_step']
+
+    dev_report = OrderedDict(step=step, dev_loss=dev_loss, dev_f1=dev_f1, dev_em=dev_em,
+                             time=time.time() - start_time, dev_f1_best=dev_f1_best,
+                             dev_f1_best_step=dev_f1_best_step)
+
+    summary = False
+    if dev_report['dev_f1_best_step'] == step:
+        summary = True
+        interface.save(iteration=step, score=dev_f1, **save_kwargs)
+        interface.pred(pred)
+    elif save_all:
+        interface.save(iteration=step, score=dev_f1, **save_kwargs)
+    print(interface.report(summary=summary, **dev_report))
+    return dev_report
+
+
+class AsyncEvaluator(object):
+    """Evaluates snapshots of the model on the dev data in a separate (forked) process, while training continues.
+
+    A snapshot copies the trainable parameters and the optimizer state, which are kept until the evaluation reports
+    back, so that the best model can be saved as it was at its step. Frozen parameters (e.g. GloVe) are not copied.
+    """
+
+    def __init__(self, args, out, device):
+        assert device.type != 'cuda' or not torch.cuda.is_initialized(), 'Must be created before CUDA is used.'
+        ctx = torch.multiprocessing.get_context('fork')
+        self._in_queue = ctx.Queue()
+        self._out_queue = ctx.Queue()
+        self._snapshots = {}
+        self._process = ctx.Process(target=_eval_process, args=(args, out, device, self._in_queue, self._out_queue),
+                                    daemon=True)
+        self._process.start()
+
+    def submit(self, step, model, optimizer):
+        model_state, copied = OrderedDict(), OrderedDict()
+        for key, val in model.state_dict(keep_vars=True).items():
+            if isinstance(val, torch.nn.Parameter) and not val.requires_grad:
+                model_state[key] = val.detach()
+            else:
+                model_state[key] = copied[key] = val.detach().cpu().clone()
+        self._snapshots[step] = {'model_state': model_state, 'optimizer_state': copy.deepcopy(optimizer.state_dict())}
+        self._in_queue.put((step, copied))
+
+    def poll(self, block=False, timeout=1.0):
+        """Yields (step, kwargs of `interface.save`, output of `evaluate`) of finished evaluations.
+
+        With `block`, waits for all submitted evaluations, checking every `timeout` seconds that the evaluation process
+        is still alive; raises `RuntimeError` if it has exited (e.g. on OOM or an exception) with evaluations pending.
+        """
+        while len(self._snapshots) > 0:
+            try:
+                step, dev_out = self._out_queue.get(block=block, timeout=timeout if block else None)
+            except queue.Empty:
+                if not block:
+                    return
+                if not self._process.is_alive():
+                    try:  # results the process put just before exiting
+                        step, dev_out = self._out_queue.get(timeout=timeout)
+                    except queue.Empty:
+                        raise RuntimeError('The evaluation process exited (exit code %s) with %d evaluations pending.'
+                                           % (self._process.exitcode, len(self._snapshots)))
+                else:
+                    continue
+            yield step, self._snapshots.pop(step), dev_out
+
+    def close(self):
+        self._in_queue.put(None)
+        self._process.join()
+
+
+def _eval_process(args, out, device, in_queue, out_queue):
+    model = Model(**args.__dict__).to(device)
+    model.init(out['processed_metadata'])
+    loss_model = Loss(**args.__dict__).to(device)
+    dev_loader = out['dev_loader']
+    if isinstance(dev_loader, DataLoader):  # a daemonic process cannot start loader workers
+        dev_loader = DataLoader(dev_loader.dataset, batch_size=dev_loader.batch_size, collate_fn=dev_loader.collate_fn,
+                                sampler=dev_loader.sampler, pin_memory=dev_loader.pin_memory)
+    dev_loader = Prefetcher(dev_loader, device)
+    while True:
+        item = in_queue.get()
+        if item is None:
+            break
+        step, model_state = item
+        model.load_state_dict(model_state, strict=False)
+        out_queue.put((step, evaluate(model, loss_model, out['processor'], out['dev_dataset'], dev_loader, step,
+                                      args.eval_steps)))
 
 
 def test(args):
     device = torch.device('cuda' if args.cuda else 'cpu')
     pprint(args.__dict__)
+    timer = StageTimer(device, enabled=args.timing)
 
     interface = FileInterface(**args.__dict__)
     processor = Processor(**args.__dict__)
     model = Model(**args.__dict__).to(device)
     interface.bind(processor, model)
 
-    interface.load(args.iteration, session=args.load_dir)
+    with timer.stage('load'):
+        interface.load(args.iteration, session=args.load_dir)
+        if args.quantize:
+            model.quantize()
 
-    test_examples = interface.load_test()
-    test_dataset = tuple(processor.preprocess(example) for example in test_examples)
+        test_examples = interface.load_test()
+    with timer.stage('preprocess'):
+        test_dataset = tuple(processor.preprocess(example) for example in test_examples)
 
     test_sampler = Sampler(test_dataset, 'test', **args.__dict__)
     test_loader = DataLoader(test_dataset, batch_size=args.batch_size, sampler=test_sampler,
                              collate_fn=processor.collate)
+    test_loader = Prefetcher(test_loader, device, timer=timer)
 
     print('Inferencing')
+    profiler = get_profiler(args, device)
     with torch.no_grad():
         model.eval()
         pred = {}
         for batch_idx, (test_batch, _) in enumerate(zip(test_loader, range(args.eval_steps))):
-            test_batch = {key: val.to(device) for key, val in test_batch.items()}
-            model_output = model(**test_batch)
-            results = processor.postprocess_batch(test_dataset, test_batch, model_output)
-            if batch_idx % args.dump_period == 0:
-                dump = processor.get_dump(test_dataset, test_batch, model_output, results)
-                interface.dump(batch_idx, dump)
+            timer.count(test_batch)
+            with timer.stage('forward'):
+                model_output = model(**test_batch)
+            with timer.stage('postprocess'):
+                results = processor.postprocess_batch(test_dataset, test_batch, model_output)
+            with timer.stage('write'):
+                if batch_idx % args.dump_period == 0:
+                    dump = processor.get_dump(test_dataset, test_batch, model_output, results)
+                    interface.dump(batch_idx, dump)
             for result in results:
                 pred[result['id']] = result['pred']
 
             print('[%d/%d]' % (batch_idx + 1, len(test_loader)))
-        interface.pred(pred)
+            if profiler is not None:
+                profiler.step()
+        with timer.stage('write'):
+            interface.pred(pred)
+    if profiler is not None:
+        profiler.stop()
+    if timer.enabled:
+        print(interface.report(**timer.summary()))
 
 
 def embed(args):
     device = torch.device('cuda' if args.cuda else 'cpu')
     pprint(args.__dict__)
+    timer = StageTimer(device, enabled=args.timing)
 
     interface = FileInterface(**args.__dict__)
     model = Model(**args.__dict__).to(device)
     processor = Processor(**args.__dict__)
     interface.bind(processor, model)
 
-    interface.load(args.iteration, session=args.load_dir)
-
-    test_examples = interface.load_test()
-    test_dataset = tuple(processor.preprocess(example) for example in test_examples)
-
-    test_sampler = Sampler(test_dataset, 'test', **args.__dict__)
+    with timer.stage('load'):
+        interface.load(args.iteration, session=args.load_dir)
+        if args.quantize:
+            model.quantize()
+
+        test_examples = interface.load_test()
+    with timer.stage('preprocess'):
+        test_dataset = tuple(processor.preprocess(example) for example in test_examples)
+    sampler_kwargs = args.__dict__
+    if args.context_window > 0:
+        test_dataset = window_dataset(processor, test_dataset, args.context_window, args.context_stride)
+        # keep the windows of each context adjacent, so that only a few contexts are pending at a time
+        sampler_kwargs = dict(sampler_kwargs, bucket=False, shuffle=False)
+
+    test_sampler = Sampler(test_dataset, 'test', **sampler_kwargs)
     test_loader = DataLoader(test_dataset, batch_size=args.batch_size, sampler=test_sampler,
                              collate_fn=processor.collate)
+    test_loader = Prefetcher(test_loader, device, timer=timer)
 
     print('Saving embeddings')
+    profiler = get_profiler(args, device)
+    num_questions, question_time = 0, 0.0
+    context_ids = []
     with torch.no_grad():
         model.eval()
         for batch_idx, (test_batch, _) in enumerate(zip(test_loader, range(args.eval_steps))):
-            test_batch = {key: val.to(device) for key, val in test_batch.items()}
+            timer.count(test_batch)
 
             if args.mode == 'embed' or args.mode == 'embed_context':
 
-                context_output = model.get_context(**test_batch)
-                context_results = processor.postprocess_context_batch(test_dataset, test_batch, context_output)
-
-                for id_, phrases, matrix in context_results:
-                    interface.context_emb(id_, phrases, matrix, emb_type=args.emb_type)
+                with timer.stage('forward'):
+                    context_output = model.get_context(**test_batch)
+                with timer.stage('postprocess'):
+                    if args.context_window > 0:
+                        context_results = processor.postprocess_context_window_batch(test_dataset, test_batch,
+                                                                                     context_output)
+                    else:
+                        context_results = processor.postprocess_context_batch(test_dataset, test_batch,
+                                                                              context_output)
+
+                with timer.stage('write'):
+                    for id_, phrases, matrix in context_results:
+                        interface.context_emb(id_, phrases, matrix, emb_type=args.emb_type)
+                        context_ids.append(id_)
 
             if args.mode == 'embed' or args.mode == 'embed_question':
 
-                question_output = model.get_question(**test_batch)
-                question_results = processor.postprocess_question_batch(test_dataset, test_batch, question_output)
+                question_start_time = time.time()
+                with timer.stage('forward'):
+                    question_output = model.get_question(**test_batch)
+                question_time += time.time() - question_start_time
+                num_questions += len(question_output)
+                with timer.stage('postprocess'):
+                    question_results = processor.postprocess_question_batch(test_dataset, test_batch,
+                                                                            question_output)
 
-                for id_, emb in question_results:
-                    interface.question_emb(id_, emb, emb_type=args.emb_type)
+                with timer.stage('write'):
+                    for id_, emb in question_results:
+                        interface.question_emb(id_, emb, emb_type=args.emb_type)
 
             print('[%d/%d]' % (batch_idx + 1, len(test_loader)))
+            if profiler is not None:
+                profiler.step()
+        if num_questions > 0:
+            print('Question encoding: %.3f ms per question (batch size %d)' % (question_time * 1000 / num_questions,
+                                                                                args.batch_size))
+    if profiler is not None:
+        profiler.stop()
+    if args.index_dir is not None and len(context_ids) > 0:
+        with timer.stage('write'):
+            num_contexts = PhraseIndex(args.index_dir).add(args.context_emb_dir, cids=context_ids)
+        print('Added %d contexts to the phrase index at %s' % (num_contexts, args.index_dir))
+    if timer.enabled:
+        print(interface.report(**timer.summary()))
+
+
+def export(args):
+    pprint(args.__dict__)
+
+    interface = FileInterface(**args.__dict__)
+    processor = Processor(**args.__dict__)
+    model = Model(**args.__dict__)
+    interface.bind(processor, model)
+
+    interface.load(args.iteration, session=args.load_dir)
+    interface.export(model.export(), processor.state_dict())
+
+
+def slim(args):
+    pprint(args.__dict__)
+
+    interface = FileInterface(**args.__dict__)
+    processor = Processor(**args.__dict__)
+    model = Model(**args.__dict__)
+    interface.bind(processor, model)
+
+    interface.load(args.iteration, session=args.load_dir, slim=False)
+    interface.save_slim(args.iteration, session=args.load_dir)
+
+
+def window_dataset(processor, dataset, window_size, stride):
+    """Splits each (unique) context of `dataset` into overlapping windows, which form a new dataset.
+    """
+    cids = set()
+    windows = []
+    for example in dataset:
+        if example['cid'] in cids:
+            continue
+        cids.add(example['cid'])
+        windows.extend(processor.window(example, window_size, stride))
+    return tuple(dict(window, idx=idx) for idx, window in enumerate(windows))
+
+
+def cache_elmo(args):
+    """Runs ELMo's biLM once per unique context and question of train and test data, and stores the activations of
+    each layer (the layer mix is part of the model).
+    """
+    device = torch.device('cuda' if args.cuda else 'cpu')
+    pprint(args.__dict__)
+
+    interface = FileInterface(**args.__dict__)
+    processor = Processor(**dict(args.__dict__, elmo_cache_dir=None))
+    model = Model(**dict(args.__dict__, elmo_cache_dir=None)).to(device)
+    model.init(processor.process_metadata(interface.load_metadata()))
+
+    examples = []
+    if os.path.exists(args.train_path):
+        examples.extend(interface.load_train())
+    examples.extend(interface.load_test())
+    sentences = processor.elmo_sentences(examples)
+    texts = sorted(sentences, key=lambda text: len(sentences[text]))
+    store = ElmoStore.create(args.elmo_cache_dir, OrderedDict((text, len(sentences[text])) for text in texts),
+                             num_layers=len(model.embedding.elmo_mix.scalar_parameters))
+
+    print('Caching ELMo activations of %d texts' % len(texts))
+    with torch.no_grad():
+        model.eval()
+        for batch_idx, i in enumerate(range(0, len(texts), args.batch_size)):
+            batch_texts = texts[i:i + args.batch_size]
+            elmo_idxs = processor.collate_elmo([sentences[text] for text in batch_texts]).to(device)
+            reps = model.get_elmo(elmo_idxs).cpu().numpy()
+            for text, rep in zip(batch_texts, reps):
+                store.put(text, rep[:len(sentences[text])])
+            print('[%d/%d]' % (batch_idx + 1, (len(texts) + args.batch_size - 1) // args.batch_size))
+    store.close()
 
 
 def main():
@@ -231,11 +668,20 @@ def main():
     argument_parser.add_arguments()
     args = argument_parser.parse_args()
     if args.mode == 'train':
-        train(args)
+        if args.num_procs > 1:
+            train_distributed(args)
+        else:
+            train(args)
     elif args.mode == 'test':
         test(args)
     elif args.mode == 'embed' or args.mode == 'embed_context' or args.mode == 'embed_question':
         embed(args)
+    elif args.mode == 'cache_elmo':
+        cache_elmo(args)
+    elif args.mode == 'export':
+        export(args)
+    elif args.mode == 'slim':
+        slim(args)
     else:
         raise Exception()
 
@@ -248,6 +694,7 @@ if __name__ == "__main__":
     Sampler = from_.Sampler
     Model = from_.Model
     Loss = from_.Loss
+    ElmoStore = getattr(from_, 'ElmoStore', None)
     assert issubclass(ArgumentParser, base.ArgumentParser)
     assert issubclass(FileInterface, base.FileInterface)
     assert issubclass(Processor, base.Processor)
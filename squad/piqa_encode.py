@@ -0,0 +1,78 @@
+""" Lightweight question encoder for PIQA, using the TorchScript encoders from `main.py --mode export`.
+
+Only requires `torch`, `numpy` and `nltk`; the model code (`base`, `baseline`) is not needed.
+"""
+import time
+
+start_time = time.time()
+
+import argparse
+import json
+import os
+
+import nltk
+import numpy as np
+import torch
+
+
+class QuestionEncoder(object):
+    def __init__(self, export_dir):
+        self._module = torch.jit.load(os.path.join(export_dir, 'question.pt'), map_location='cpu')
+        with open(os.path.join(export_dir, 'processor.json'), 'r') as fp:
+            state = json.load(fp)
+        self._word2idx_dict = state['word2idx']
+        self._word2idx_ext_dict = state['word2idx_ext']
+        self._char2idx_dict = state['char2idx']
+
+    def encode(self, questions):
+        """Encodes a list of question strings into a [len(questions), d] matrix."""
+        words = [tokenize(question) for question in questions]
+        max_len = max(max(len(each) for each in words), 1)
+        max_char_len = max(max([len(word) for each in words for word in each] or [1]), 1)
+        word_idxs = torch.zeros(len(words), max_len, dtype=torch.int64)
+        glove_idxs = torch.zeros(len(words), max_len, dtype=torch.int64)
+        char_idxs = torch.zeros(len(words), max_len, max_char_len, dtype=torch.int64)
+        for i, each in enumerate(words):
+            for j, word in enumerate(each):
+                word_idxs[i, j] = self._word2idx_dict.get(word, 1)
+                glove_idxs[i, j] = self._word2idx_ext_dict.get(word.lower(), 1)
+                char_idxs[i, j, :len(word)] = torch.tensor([self._char2idx_dict.get(char, 1) for char in word])
+        with torch.no_grad():
+            return self._module(char_idxs, glove_idxs, word_idxs).numpy()
+
+
+def tokenize(in_):
+    """Identical to `baseline.processor.PTBWordTokenizer`, without the spans."""
+    in_ = in_.replace('``', '" ').replace("''", '" ').replace('\t', ' ')
+    words = nltk.word_tokenize(in_)
+    return [word.replace('``', '"').replace("''", '"') for word in words]
+
+
+def load_questions(question_path):
+    with open(question_path, 'r') as fp:
+        dataset = json.load(fp)['data']
+    return [(qa['id'], qa['question']) for article in dataset for paragraph in article['paragraphs']
+            for qa in paragraph['qas']]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Question encoder for PIQA from exported TorchScript encoders')
+    parser.add_argument('export_dir', help='Directory of exported encoders')
+    parser.add_argument('question_path', help='Question file, e.g. dev-v1.1-question.json')
+    parser.add_argument('question_emb_dir', help='Question embedding directory')
+    parser.add_argument('--batch_size', type=int, default=64)
+    args = parser.parse_args()
+
+    encoder = QuestionEncoder(args.export_dir)
+    questions = load_questions(args.question_path)
+    print('Loaded in %.2fs' % (time.time() - start_time))
+    if not os.path.exists(args.question_emb_dir):
+        os.makedirs(args.question_emb_dir)
+    for i in range(0, len(questions), args.batch_size):
+        batch = questions[i:i + args.batch_size]
+        embs = encoder.encode([question for _, question in batch])
+        for (id_, _), emb in zip(batch, embs):
+            np.savez(os.path.join(args.question_emb_dir, '%s.npz' % id_), emb[None, :])
+        if i == 0:
+            print('First batch encoded in %.2fs' % (time.time() - start_time))
+    print('Encoded %d questions in %.2fs' % (len(questions), time.time() - start_time))
@@ -91,36 +91,108 @@ def get_q2c(dataset):
     return q2c
 
 
+class SpanPhrases(object):
+    """Phrases given as character offsets into their context; a phrase string is only sliced when it is accessed."""
+    def __init__(self, context, spans):
+        self.context = context
+        self.spans = spans
+
+    def __len__(self):
+        return len(self.spans)
+
+    def __getitem__(self, idx):
+        start, end = self.spans[idx]
+        return self.context[start:end]
+
+
+def load_phrases(context_emb_dir, cid):
+    """Loads the phrases of a context: a list of strings in `<cid>.json`, or `SpanPhrases` if it is a dict of the
+    `context` (with the [N, 2] offsets in `<cid>.spans.npy`).
+    """
+    with open(os.path.join(context_emb_dir, '%s.json' % cid), 'r') as fp:
+        phrases = json.load(fp)
+    if isinstance(phrases, dict):
+        return SpanPhrases(phrases['context'], np.load(os.path.join(context_emb_dir, '%s.spans.npy' % cid)))
+    return phrases
+
+
+def same_phrases(phrases, other):
+    """Whether two phrase lists (see `load_phrases`) list the same phrases in the same order: the same spans if both
+    are offsets into the same context, otherwise the same strings.
+    """
+    if len(phrases) != len(other):
+        return False
+    if isinstance(phrases, SpanPhrases) and isinstance(other, SpanPhrases) and phrases.context == other.context:
+        return np.array_equal(phrases.spans, other.spans)
+    return all(phrases[idx] == other[idx] for idx in range(len(phrases)))
+
+
+def load_sparse_context(path):
+    """Loads a sparse context embedding as CSR, with the row (phrase) of each of its non-zeros."""
+    c_emb = scipy.sparse.load_npz(path).tocsr()
+    rows = np.repeat(np.arange(c_emb.shape[0]), np.diff(c_emb.indptr))
+    return c_emb, rows
+
+
+def sparse_scores(c_emb, rows, q_emb):
+    """Inner products of the phrases of `c_emb` (from `load_sparse_context`) and each row of `q_emb`, shape = [N, M].
+
+    Each question row is kept as sorted index/value arrays, and every non-zero of the context is looked up in it, so
+    the cost is linear in the number of non-zeros and no sparse product (or its densification) is needed.
+    """
+    q_emb = q_emb.tocsr()
+    q_emb.sort_indices()
+    scores = np.zeros([c_emb.shape[0], q_emb.shape[0]], dtype=np.float32)
+    for j in range(q_emb.shape[0]):
+        q_idx = q_emb.indices[q_emb.indptr[j]:q_emb.indptr[j + 1]]
+        q_val = q_emb.data[q_emb.indptr[j]:q_emb.indptr[j + 1]]
+        if len(q_idx) == 0:
+            continue
+        pos = np.minimum(np.searchsorted(q_idx, c_emb.indices), len(q_idx) - 1)
+        hit = q_idx[pos] == c_emb.indices
+        scores[:, j] = np.bincount(rows[hit], weights=c_emb.data[hit] * q_val[pos[hit]], minlength=c_emb.shape[0])
+    return scores
+
+
 def get_predictions(context_emb_dir, question_emb_dir, q2c, sparse=False, progress=False):
     if progress:
         from tqdm import tqdm
     else:
         tqdm = lambda x: x
+    snapshot = None
+    if os.path.exists(os.path.join(context_emb_dir, 'manifest.json')):
+        # a phrase index (`piqa_index.py`) of dense context embeddings
+        from piqa_index import PhraseIndex
+        assert not sparse, 'A phrase index only has dense embeddings.'
+        snapshot = PhraseIndex(context_emb_dir).snapshot()
     predictions = {}
+    last_cid = None
     for id_, cid in tqdm(q2c.items()):
         q_emb_path = os.path.join(question_emb_dir, '%s.npz' % id_)
         c_emb_path = os.path.join(context_emb_dir, '%s.npz' % cid)
-        c_json_path = os.path.join(context_emb_dir, '%s.json' % cid)
 
-        if not os.path.exists(q_emb_path):
+        if not os.path.exists(q_emb_path) or (snapshot is not None and cid not in snapshot):
             continue
 
-        load = scipy.sparse.load_npz if sparse else np.load
-        q_emb = load(q_emb_path)  # shape = [M, d], d is the embedding size.
-        c_emb = load(c_emb_path)  # shape = [N, d], d is the embedding size.
-
-        with open(c_json_path, 'r') as fp:
-            phrases = json.load(fp)
+        # Questions of a context are consecutive, so each context is loaded once
+        if cid != last_cid and snapshot is not None:
+            c_emb, phrases = snapshot.context(cid)
+            last_cid = cid
+        elif cid != last_cid:
+            if sparse:
+                c_emb, rows = load_sparse_context(c_emb_path)  # shape = [N, d], d is the embedding size.
+            else:
+                c_emb = np.load(c_emb_path)['arr_0']  # shape = [N, d], d is the embedding size.
+            phrases = load_phrases(context_emb_dir, cid)
+            last_cid = cid
 
         if sparse:
-            sim = c_emb * q_emb.T
-            m = sim.max(1)
-            m = np.squeeze(np.array(m.todense()), 1)
+            q_emb = scipy.sparse.load_npz(q_emb_path)  # shape = [M, d], d is the embedding size.
+            sim = sparse_scores(c_emb, rows, q_emb)
         else:
-            q_emb = q_emb['arr_0']
-            c_emb = c_emb['arr_0']
+            q_emb = np.load(q_emb_path)['arr_0']  # shape = [M, d], d is the embedding size.
             sim = np.matmul(c_emb, q_emb.T)
-            m = sim.max(1)
+        m = sim.max(1)
 
         argmax = m.argmax(0)
         predictions[id_] = phrases[argmax]
@@ -132,6 +204,53 @@ def get_predictions(context_emb_dir, question_emb_dir, q2c, sparse=False, progre
     return predictions
 
 
+def get_hybrid_predictions(context_emb_dir, question_emb_dir, sparse_context_emb_dir, sparse_question_emb_dir, q2c,
+                           sparse_weights=(1.0,), progress=False):
+    """Scores phrases by `dense + sparse_weight * sparse` inner products, and returns predictions for each weight.
+
+    The dense and sparse context embeddings must be aligned, i.e. have the same phrases in the same order, which is
+    checked against the phrases of both.
+    Embeddings are loaded once for all weights, and sparse ones are scored with `sparse_scores`.
+    """
+    if progress:
+        from tqdm import tqdm
+    else:
+        tqdm = lambda x: x
+    predictions = [{} for _ in sparse_weights]
+    last_cid = None
+    for id_, cid in tqdm(q2c.items()):
+        q_emb_path = os.path.join(question_emb_dir, '%s.npz' % id_)
+        sq_emb_path = os.path.join(sparse_question_emb_dir, '%s.npz' % id_)
+        c_emb_path = os.path.join(context_emb_dir, '%s.npz' % cid)
+        sc_emb_path = os.path.join(sparse_context_emb_dir, '%s.npz' % cid)
+
+        if not os.path.exists(q_emb_path) or not os.path.exists(sq_emb_path):
+            continue
+
+        if cid != last_cid:
+            c_emb = np.load(c_emb_path)['arr_0']  # shape = [N, d]
+            sc_emb, rows = load_sparse_context(sc_emb_path)  # shape = [N, d'], d' is the sparse embedding size.
+            phrases = load_phrases(context_emb_dir, cid)
+            if c_emb.shape[0] != sc_emb.shape[0] or not same_phrases(phrases,
+                                                                     load_phrases(sparse_context_emb_dir, cid)):
+                raise ValueError('Dense and sparse phrases of %s are not aligned (%d vs. %d phrases)' % (
+                    cid, c_emb.shape[0], sc_emb.shape[0]))
+            last_cid = cid
+        q_emb = np.load(q_emb_path)['arr_0']  # shape = [M, d]
+        sq_emb = scipy.sparse.load_npz(sq_emb_path)  # shape = [M, d']
+
+        if q_emb.shape[0] != sq_emb.shape[0]:
+            raise ValueError('Dense and sparse embeddings of %s are not aligned: %d vs. %d' % (
+                id_, q_emb.shape[0], sq_emb.shape[0]))
+
+        dense_sim = np.matmul(c_emb, q_emb.T)
+        sparse_sim = sparse_scores(sc_emb, rows, sq_emb)
+        for each_predictions, sparse_weight in zip(predictions, sparse_weights):
+            m = (dense_sim + sparse_weight * sparse_sim).max(1)
+            each_predictions[id_] = phrases[m.argmax(0)]
+
+    return predictions
+
 if __name__ == '__main__':
     expected_version = '1.1'
     parser = argparse.ArgumentParser(
@@ -142,6 +261,12 @@ if __name__ == '__main__':
     parser.add_argument('--sparse', default=False, action='store_true',
                         help='Whether the embeddings are scipy.sparse or pure numpy.')
     parser.add_argument('--progress', default=False, action='store_true', help='Show progress bar. Requires `tqdm`.')
+    parser.add_argument('--sparse_context_emb_dir', default=None,
+                        help='Sparse context embedding directory, aligned with the (dense) context embeddings. '
+                             'If given, phrases are scored with both (hybrid).')
+    parser.add_argument('--sparse_question_emb_dir', default=None, help='Sparse question embedding directory')
+    parser.add_argument('--sparse_weight', default='1.0',
+                        help='Weight of the sparse scores in hybrid mode; comma-separated values for a sweep.')
     args = parser.parse_args()
     with open(args.dataset_file) as dataset_file:
         dataset_json = json.load(dataset_file)
@@ -151,6 +276,15 @@ if __name__ == '__main__':
                   file=sys.stderr)
         dataset = dataset_json['data']
     q2c = get_q2c(dataset)
+    if args.sparse_context_emb_dir is not None:
+        assert args.sparse_question_emb_dir is not None, '`--sparse_question_emb_dir` is required for hybrid.'
+        sparse_weights = [float(each) for each in args.sparse_weight.split(',')]
+        all_predictions = get_hybrid_predictions(args.context_emb_dir, args.question_emb_dir,
+                                                 args.sparse_context_emb_dir, args.sparse_question_emb_dir, q2c,
+                                                 sparse_weights=sparse_weights, progress=args.progress)
+        for sparse_weight, predictions in zip(sparse_weights, all_predictions):
+            print(json.dumps(dict(sparse_weight=sparse_weight, **evaluate(dataset, predictions))))
+        sys.exit()
     predictions = get_predictions(args.context_emb_dir, args.question_emb_dir, q2c, sparse=args.sparse,
                                   progress=args.progress)
     print(json.dumps(evaluate(dataset, predictions)))
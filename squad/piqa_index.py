@@ -0,0 +1,293 @@
+""" Incrementally updatable phrase index over dense context embeddings (`context_emb_dir` dumps).
+
+The index is a list of immutable segments, each holding the phrase vectors and phrases of some contexts, and a
+`manifest.json` that is atomically replaced on every update. Adding contexts writes a new segment; re-adding or removing
+a context tombstones its older rows instead of rewriting segments, and compaction merges the live rows of all segments
+into one. Readers work on a snapshot (one version of the manifest), so they never see a partial update.
+
+Only requires `numpy`.
+"""
+import argparse
+import fcntl
+import json
+import os
+import shutil
+import threading
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+
+from piqa_evaluate import SpanPhrases, load_phrases
+
+MANIFEST = 'manifest.json'
+SUMMARIES = ('max', 'mean')
+
+
+class PhraseIndex(object):
+    def __init__(self, index_dir):
+        self._index_dir = index_dir
+        if not os.path.exists(os.path.join(index_dir, MANIFEST)):
+            if not os.path.exists(index_dir):
+                os.makedirs(index_dir)
+            with self._lock():
+                if not os.path.exists(os.path.join(index_dir, MANIFEST)):
+                    self._write_manifest({'next_seq': 0, 'segments': [], 'tombstones': {}})
+
+    def snapshot(self):
+        """A consistent, read-only view of the index as of now."""
+        while True:
+            manifest = self._read_manifest()
+            try:
+                return Snapshot(self._index_dir, manifest)
+            except FileNotFoundError:
+                # a segment was compacted away in between; read the newer manifest
+                continue
+
+    def add(self, context_emb_dir, cids=None):
+        """Adds (or replaces) the contexts `cids` (default: all) of a `context_emb_dir` as a new segment."""
+        if cids is None:
+            cids = sorted(name[:-4] for name in os.listdir(context_emb_dir) if name.endswith('.npz'))
+        cids = list(OrderedDict.fromkeys(cids))
+        if len(cids) == 0:
+            return 0
+        contexts = ((cid, (np.load(os.path.join(context_emb_dir, '%s.npz' % cid))['arr_0'],
+                           load_phrases(context_emb_dir, cid))) for cid in cids)
+        name = self._write_segment(contexts)
+        with self._lock():
+            manifest = self._read_manifest()
+            seq = manifest['next_seq']
+            manifest['next_seq'] += 1
+            if name is not None:
+                manifest['segments'].append({'name': name, 'seq': seq})
+            for cid in cids:
+                manifest['tombstones'][cid] = seq - 1  # rows of `cid` in older segments are dead
+            self._write_manifest(manifest)
+        return len(cids)
+
+    def remove(self, cids):
+        with self._lock():
+            manifest = self._read_manifest()
+            for cid in cids:
+                manifest['tombstones'][cid] = manifest['next_seq'] - 1
+            self._write_manifest(manifest)
+
+    def compact(self, background=False):
+        """Merges the live rows of all current segments into one segment.
+
+        Updates made meanwhile are kept, so with `background`, this runs in a thread (which is returned) while the
+        index is still read and updated.
+        """
+        if background:
+            thread = threading.Thread(target=self.compact)
+            thread.start()
+            return thread
+        snapshot = self.snapshot()
+        if len(snapshot.segments) <= 1 and not snapshot.num_dead:
+            return None
+        name = self._write_segment(snapshot.contexts())
+        compacted = set(segment['name'] for segment in snapshot.segments)
+        seq = max(segment['seq'] for segment in snapshot.segments)
+        with self._lock():
+            manifest = self._read_manifest()
+            if not compacted <= set(segment['name'] for segment in manifest['segments']):
+                # another compaction replaced some of these segments meanwhile; publishing this one would duplicate
+                # their live rows
+                if name is not None:
+                    shutil.rmtree(os.path.join(self._index_dir, name))
+                return None
+            # segments added during compaction have larger sequence numbers, and tombstones added meanwhile (e.g.
+            # by `remove`) are at least `seq`, so they still apply to the compacted segment
+            merged = [{'name': name, 'seq': seq}] if name is not None else []
+            manifest['segments'] = merged + [
+                segment for segment in manifest['segments'] if segment['name'] not in compacted]
+            manifest['tombstones'] = {cid: each for cid, each in manifest['tombstones'].items() if each >= seq}
+            self._write_manifest(manifest)
+        # open snapshots have the old segments mapped, and new ones retry on a missing segment
+        for each in compacted:
+            shutil.rmtree(os.path.join(self._index_dir, each))
+        return name
+
+    def _write_segment(self, contexts):
+        """Writes a segment of (cid, ([N, d] embedding, phrases)) pairs and returns its name.
+
+        Contexts without any phrase are skipped, and no segment is written (None is returned) if none are left.
+        """
+        name = uuid.uuid4().hex
+        tmp_dir = os.path.join(self._index_dir, name + '.tmp')
+        os.makedirs(tmp_dir)
+        embs, spans, meta, num_rows = [], [], [], 0
+        for cid, (emb, phrases) in contexts:
+            if len(emb) == 0:
+                continue
+            each = {'cid': cid, 'start': num_rows, 'end': num_rows + len(emb)}
+            if isinstance(phrases, SpanPhrases):
+                each['context'] = phrases.context
+                spans.append(np.asarray(phrases.spans, dtype=np.int32))
+            else:
+                each['phrases'] = list(phrases)
+                spans.append(np.zeros([len(emb), 2], dtype=np.int32))
+            embs.append(np.asarray(emb, dtype=np.float32))
+            meta.append(each)
+            num_rows += len(emb)
+        if num_rows == 0:
+            os.rmdir(tmp_dir)
+            return None
+        np.save(os.path.join(tmp_dir, 'emb.npy'), np.concatenate(embs, 0))
+        np.save(os.path.join(tmp_dir, 'spans.npy'), np.concatenate(spans, 0))
+        for kind in SUMMARIES:
+            np.save(os.path.join(tmp_dir, 'summary_%s.npy' % kind), np.stack([_summarize(emb, kind) for emb in embs]))
+        with open(os.path.join(tmp_dir, 'contexts.json'), 'w') as fp:
+            json.dump(meta, fp)
+        os.rename(tmp_dir, os.path.join(self._index_dir, name))
+        return name
+
+    def _read_manifest(self):
+        with open(os.path.join(self._index_dir, MANIFEST), 'r') as fp:
+            return json.load(fp)
+
+    def _write_manifest(self, manifest):
+        path = os.path.join(self._index_dir, MANIFEST)
+        with open(path + '.tmp', 'w') as fp:
+            json.dump(manifest, fp)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(path + '.tmp', path)
+
+    @contextmanager
+    def _lock(self):
+        with open(os.path.join(self._index_dir, 'lock'), 'w') as fp:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fp, fcntl.LOCK_UN)
+
+
+class Snapshot(object):
+    def __init__(self, index_dir, manifest):
+        self.segments = manifest['segments']
+        self.num_dead = 0
+        self._embs = []
+        self._live = []
+        self._starts = []  # start row and cid of each context, per segment
+        self._rows = {}  # cid -> (segment index, start, end, context meta, spans)
+        self._summaries = {}
+        self._segment_dirs = [os.path.join(index_dir, segment['name']) for segment in self.segments]
+        for k, segment in enumerate(self.segments):
+            segment_dir = os.path.join(index_dir, segment['name'])
+            emb = np.load(os.path.join(segment_dir, 'emb.npy'), mmap_mode='r')
+            spans = np.load(os.path.join(segment_dir, 'spans.npy'), mmap_mode='r')
+            with open(os.path.join(segment_dir, 'contexts.json'), 'r') as fp:
+                meta = json.load(fp)
+            live = np.zeros(len(emb), dtype=bool)
+            for each in meta:
+                if manifest['tombstones'].get(each['cid'], -1) < segment['seq']:
+                    live[each['start']:each['end']] = True
+                    self._rows[each['cid']] = (k, each['start'], each['end'], each, spans)
+                else:
+                    self.num_dead += 1
+            self._embs.append(emb)
+            self._live.append(live)
+            self._starts.append((np.array([each['start'] for each in meta], dtype=np.int64),
+                                 [each['cid'] for each in meta]))
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, cid):
+        return cid in self._rows
+
+    def context(self, cid):
+        """The [N, d] phrase vectors and the phrases of a context."""
+        k, start, end, meta, spans = self._rows[cid]
+        if 'context' in meta:
+            phrases = SpanPhrases(meta['context'], spans[start:end])
+        else:
+            phrases = meta['phrases']
+        return self._embs[k][start:end], phrases
+
+    def contexts(self):
+        for cid in self._rows:
+            yield cid, self.context(cid)
+
+    def candidates(self, q_emb, top_p, summary='max'):
+        """The `top_p` live contexts (cids) whose summary vector (the `summary` of their phrase vectors) has the
+        largest inner product with a [d] question vector, best first.
+        """
+        cids, summaries = self.summaries(summary)
+        if len(cids) == 0:
+            return []
+        scores = summaries.dot(q_emb)
+        idxs = np.argpartition(-scores, min(top_p, len(scores)) - 1)[:top_p]
+        return [cids[idx] for idx in idxs[np.argsort(-scores[idxs])]]
+
+    def summaries(self, summary='max'):
+        """The cids of the live contexts, and their [C, d] summary vectors (computed once per snapshot)."""
+        if summary not in self._summaries:
+            saved, positions = [], []
+            for segment_dir, (_, segment_cids) in zip(self._segment_dirs, self._starts):
+                path = os.path.join(segment_dir, 'summary_%s.npy' % summary)
+                saved.append(np.load(path) if os.path.exists(path) else None)
+                positions.append({cid: i for i, cid in enumerate(segment_cids)})
+            cids, vecs = [], []
+            for cid, (k, start, end, _, _) in self._rows.items():
+                cids.append(cid)
+                if saved[k] is not None:
+                    vecs.append(saved[k][positions[k][cid]])
+                else:
+                    vecs.append(_summarize(self._embs[k][start:end], summary))
+            self._summaries[summary] = (cids, np.stack(vecs) if vecs else np.zeros([0, 0], np.float32))
+        return self._summaries[summary]
+
+    def search(self, q_emb, top_k=10, top_p=None, summary='max'):
+        """Top `top_k` (cid, phrase, score) over all live phrases, for a [d] question vector.
+
+        With `top_p`, only the phrases of the `top_p` candidate contexts (see `candidates`) are scored.
+        """
+        if top_p is not None:
+            results = []
+            for cid in self.candidates(q_emb, top_p, summary=summary):
+                emb, phrases = self.context(cid)
+                scores = np.asarray(emb).dot(q_emb)
+                results.extend((float(scores[idx]), cid, phrases[idx]) for idx in np.argsort(-scores)[:top_k])
+            return [(cid, phrase, score) for score, cid, phrase in sorted(results, key=lambda x: -x[0])[:top_k]]
+        results = []
+        for k, (emb, live) in enumerate(zip(self._embs, self._live)):
+            if not live.any():
+                continue
+            scores = np.where(live, np.asarray(emb).dot(q_emb), -np.inf)
+            idxs = np.argpartition(-scores, min(top_k, len(scores)) - 1)[:top_k]
+            results.extend((float(scores[idx]), k, int(idx)) for idx in idxs if live[idx])
+        results = sorted(results, reverse=True)[:top_k]
+        return [self._lookup(k, idx) + (score,) for score, k, idx in results]
+
+    def _lookup(self, k, idx):
+        starts, cids = self._starts[k]
+        cid = cids[np.searchsorted(starts, idx, side='right') - 1]
+        return cid, self.context(cid)[1][idx - self._rows[cid][1]]
+
+
+def _summarize(emb, summary):
+    return np.asarray(emb).max(0) if summary == 'max' else np.asarray(emb).mean(0)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Incrementally updatable phrase index')
+    parser.add_argument('command', help='add|remove|compact|info')
+    parser.add_argument('index_dir')
+    parser.add_argument('args', nargs='*', help='add: context_emb_dir [cid ...]; remove: cid ...')
+    args = parser.parse_args()
+
+    index = PhraseIndex(args.index_dir)
+    if args.command == 'add':
+        print('Added %d contexts' % index.add(args.args[0], cids=args.args[1:] or None))
+    elif args.command == 'remove':
+        index.remove(args.args)
+    elif args.command == 'compact':
+        index.compact()
+    elif args.command != 'info':
+        raise ValueError(args.command)
+    snapshot = index.snapshot()
+    print('%d segments, %d contexts, %d dead' % (len(snapshot.segments), len(snapshot), snapshot.num_dead))
@@ -0,0 +1,61 @@
+import argparse
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+import torch
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from baseline.model import SelfSeqAtt
+
+
+def run(args, length, chunk_size):
+    """Returns (ms per forward, peak memory in MB) of one `SelfSeqAtt` forward at the given context length.
+
+    Meant to be run in a fresh process, so that the peak RSS on CPU is not shadowed by earlier runs.
+    """
+    device = torch.device('cuda' if args.cuda else 'cpu')
+    torch.manual_seed(0)
+    att = SelfSeqAtt(2 * args.hidden_size, args.hidden_size, 0.0, chunk_size=chunk_size).to(device).eval()
+    input_ = torch.randn(args.batch_size, length, 2 * args.hidden_size).to(device)
+    mask = torch.zeros(args.batch_size, length).to(device)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base_memory = torch.cuda.max_memory_allocated()
+    else:
+        base_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    start_time = time.time()
+    with torch.no_grad():
+        for _ in range(args.num_iters):
+            out = att(input_, mask)['value']
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        peak_memory = torch.cuda.max_memory_allocated()
+    else:
+        peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    duration = time.time() - start_time
+    return duration * 1000 / args.num_iters, (peak_memory - base_memory) / 2 ** 20, out.sum().item()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of full vs. chunked self-attention')
+    parser.add_argument('--num_iters', default=3, type=int)
+    parser.add_argument('--batch_size', default=16, type=int)
+    parser.add_argument('--hidden_size', default=128, type=int)
+    parser.add_argument('--lengths', default='256,512,1024,2048,4096', type=str)
+    parser.add_argument('--chunk_size', default=256, type=int)
+    parser.add_argument('--cuda', default=False, action='store_true')
+    args = parser.parse_args()
+
+    ctx = multiprocessing.get_context('spawn')
+    for length in map(int, args.lengths.split(',')):
+        results = []
+        for chunk_size in (0, args.chunk_size):
+            with ctx.Pool(1) as pool:
+                results.append(pool.apply(run, (args, length, chunk_size)))
+        (full_ms, full_mb, full_sum), (chunk_ms, chunk_mb, chunk_sum) = results
+        print('L=%d: full %.1f ms, %.1f MB; chunked %.1f ms, %.1f MB; |sum diff|=%.2e' % (
+            length, full_ms, full_mb, chunk_ms, chunk_mb, abs(full_sum - chunk_sum)))
@@ -0,0 +1,67 @@
+import argparse
+import os
+import sys
+import time
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from baseline.model import Loss
+from main import all_reduce_grads, broadcast_params
+from scripts.benchmark_encoder import get_batch, get_model
+
+
+def run(rank, args, num_procs, queue):
+    """Trains for `args.num_iters` steps in one of `num_procs` processes, and puts the duration (from rank 0)."""
+    dist.init_process_group('gloo', init_method='tcp://127.0.0.1:%d' % args.port, rank=rank, world_size=num_procs)
+    torch.set_num_threads(max(os.cpu_count() // num_procs, 1))
+    device = torch.device('cpu')
+    torch.manual_seed(0)  # the same (frozen) GloVe in all processes
+    model = get_model(args, device)
+    broadcast_params(model)
+    torch.manual_seed(rank)
+    batches = [get_batch(args.batch_size, args.min_len, args.max_len, args.question_len, args.vocab_size, device)
+               for _ in range(args.num_iters + 1)]
+    loss_model = Loss()
+    optimizer = torch.optim.Adam(p for p in model.parameters() if p.requires_grad)
+    model.train()
+    for i, batch in enumerate(batches):
+        if i == 1:  # the first step is a warm-up
+            dist.barrier()
+            start_time = time.time()
+        loss = loss_model(**model(**batch), **batch)
+        optimizer.zero_grad()
+        loss.backward()
+        if num_procs > 1:
+            all_reduce_grads(model, num_procs)
+        optimizer.step()
+    dist.barrier()
+    if rank == 0:
+        queue.put(time.time() - start_time)
+    dist.destroy_process_group()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Scaling of data-parallel CPU training (`--num_procs`)')
+    parser.add_argument('--num_procs', default='1,2,4,8', type=str)
+    parser.add_argument('--num_iters', default=10, type=int)
+    parser.add_argument('--batch_size', default=16, type=int, help='batch size per process')
+    parser.add_argument('--min_len', default=50, type=int)
+    parser.add_argument('--max_len', default=256, type=int)
+    parser.add_argument('--question_len', default=16, type=int)
+    parser.add_argument('--vocab_size', default=1002, type=int)
+    parser.add_argument('--embed_size', default=200, type=int)
+    parser.add_argument('--hidden_size', default=128, type=int)
+    parser.add_argument('--num_heads', default=1, type=int)
+    parser.add_argument('--port', default=29501, type=int)
+    args = parser.parse_args()
+
+    base_speed = None
+    for num_procs in map(int, args.num_procs.split(',')):
+        queue = mp.get_context('spawn').SimpleQueue()
+        mp.spawn(run, args=(args, num_procs, queue), nprocs=num_procs)
+        speed = num_procs * args.batch_size * args.num_iters / queue.get()
+        base_speed = base_speed or speed
+        print('%d processes: %.1f examples/s (%.2fx)' % (num_procs, speed, speed / base_speed))
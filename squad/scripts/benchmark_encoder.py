@@ -0,0 +1,149 @@
+import argparse
+import os
+import sys
+import time
+from collections import OrderedDict
+
+import torch
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from baseline.model import Model, Loss
+
+
+def get_batch(batch_size, min_len, max_len, question_len, vocab_size, device):
+    lengths = torch.randint(min_len, max_len + 1, (batch_size,))
+    max_len = int(lengths.max())
+    context_glove_idxs = torch.randint(2, vocab_size, (batch_size, max_len))
+    context_glove_idxs[torch.arange(max_len).unsqueeze(0) >= lengths.unsqueeze(1)] = 0
+    question_glove_idxs = torch.randint(2, vocab_size, (batch_size, question_len))
+    batch = {'context_char_idxs': torch.randint(1, 100, (batch_size, max_len, 8)),
+             'context_glove_idxs': context_glove_idxs,
+             'context_word_idxs': context_glove_idxs.clone(),
+             'question_char_idxs': torch.randint(1, 100, (batch_size, question_len, 8)),
+             'question_glove_idxs': question_glove_idxs,
+             'question_word_idxs': question_glove_idxs.clone(),
+             'answer_word_starts': torch.ones(batch_size, 1, dtype=torch.int64),
+             'answer_word_ends': torch.ones(batch_size, 1, dtype=torch.int64)}
+    return {key: val.to(device) for key, val in batch.items()}
+
+
+def get_model(args, device, **kwargs):
+    model = Model(char_vocab_size=100, glove_vocab_size=args.vocab_size, word_vocab_size=args.vocab_size,
+                  hidden_size=args.hidden_size, embed_size=args.embed_size, dropout=0.0, num_heads=args.num_heads,
+                  num_layers=args.num_layers, **kwargs).to(device)
+    model.init({'glove_emb_mat': torch.randn(args.vocab_size - 2, args.embed_size)})
+    return model
+
+
+def sync(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+
+def bench_train(model, batches, device):
+    loss_model = Loss()
+    optimizer = torch.optim.Adam(p for p in model.parameters() if p.requires_grad)
+    model.train()
+    sync(device)
+    start_time = time.time()
+    for batch in batches:
+        batch = dict(batch)
+        batch['answer_word_starts'] = batch['answer_word_starts'].clone()
+        batch['answer_word_ends'] = batch['answer_word_ends'].clone()
+        loss = loss_model(**model(**batch), **batch)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+    sync(device)
+    return sum(batch['context_glove_idxs'].size(0) for batch in batches) / (time.time() - start_time)
+
+
+def bench_embed(model, batches, device):
+    model.eval()
+    sync(device)
+    start_time = time.time()
+    with torch.no_grad():
+        for batch in batches:
+            model.get_context(**batch)
+            model.get_question(**batch)
+    sync(device)
+    return sum(batch['context_glove_idxs'].size(0) for batch in batches) / (time.time() - start_time)
+
+
+def check_parity(ref_model, model, batch, unpadded=False):
+    """Max abs difference of `model` against `ref_model`, optionally running each example alone (without any pad)."""
+    ref_model.eval()
+    model.eval()
+    with torch.no_grad():
+        out = model(**batch)
+        if not unpadded:
+            ref = ref_model(**batch)
+            return max(float((out[key] - ref[key]).abs().max()) for key in ('x1', 'x2', 'q1', 'q2'))
+        diff = 0.0
+        for k in range(batch['context_glove_idxs'].size(0)):
+            length = int((batch['context_glove_idxs'][k] > 0).sum())
+            single = {key: val[k:k + 1] for key, val in batch.items()}
+            for key in ('context_char_idxs', 'context_glove_idxs', 'context_word_idxs'):
+                single[key] = single[key][:, :length]
+            ref = ref_model(**single)
+            for key in ('x1', 'x2', 'q1', 'q2'):
+                each = out[key][k, :length] if key.startswith('x') else out[key][k]
+                diff = max(diff, float((each - ref[key][0]).abs().max()))
+    return diff
+
+
+def check_grad_parity(ref_model, model, batch):
+    """Max abs difference of the outputs and parameter gradients of `model` against `ref_model` in training mode."""
+    outs = []
+    grads = []
+    for each in (ref_model, model):
+        each.train()
+        each.zero_grad()
+        out = each(**batch)
+        sum(out[key].sum() for key in ('x1', 'x2', 'q1', 'q2')).backward()
+        grads.append({name: param.grad for name, param in each.named_parameters() if param.grad is not None})
+        outs.append({key: val.detach() for key, val in out.items()})
+    diff = max(float((outs[1][key] - outs[0][key]).abs().max()) for key in ('x1', 'x2', 'q1', 'q2'))
+    assert set(grads[0]) == set(grads[1]), set(grads[0]) ^ set(grads[1])
+    return max([diff] + [float((grads[1][name] - grad).abs().max()) for name, grad in grads[0].items()])
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of padded vs. packed and unfused vs. fused encoders')
+    parser.add_argument('--num_iters', default=10, type=int)
+    parser.add_argument('--batch_size', default=64, type=int)
+    parser.add_argument('--min_len', default=50, type=int)
+    parser.add_argument('--max_len', default=256, type=int)
+    parser.add_argument('--question_len', default=16, type=int)
+    parser.add_argument('--vocab_size', default=1002, type=int)
+    parser.add_argument('--embed_size', default=200, type=int)
+    parser.add_argument('--hidden_size', default=128, type=int)
+    parser.add_argument('--num_heads', default=1, type=int)
+    parser.add_argument('--num_layers', default=1, type=int,
+                        help='deeper context LSTMs require `hidden_size` == `embed_size` (their input size is 2x)')
+    parser.add_argument('--cuda', default=False, action='store_true')
+    args = parser.parse_args()
+
+    device = torch.device('cuda' if args.cuda else 'cpu')
+    torch.manual_seed(0)
+    batches = [get_batch(args.batch_size, args.min_len, args.max_len, args.question_len, args.vocab_size, device)
+               for _ in range(args.num_iters)]
+
+    models = OrderedDict()
+    models['padded'] = get_model(args, device)
+    models['packed'] = get_model(args, device, packed=True)
+    models['fused'] = get_model(args, device, fused=True)
+    models['packed+fused'] = get_model(args, device, packed=True, fused=True)
+    for model in models.values():
+        model.load_state_dict(models['padded'].state_dict())
+
+    print('parity: max abs diff of packed vs. unpadded = %.3e' % check_parity(models['padded'], models['packed'],
+                                                                             batches[0], unpadded=True))
+    print('parity: max abs diff of fused vs. padded = %.3e' % check_parity(models['padded'], models['fused'],
+                                                                          batches[0]))
+    print('parity: max abs diff of packed+fused vs. packed = %.3e' % check_parity(models['packed'],
+                                                                                 models['packed+fused'], batches[0]))
+    print('parity: max abs diff of fused vs. padded outputs and gradients in training = %.3e' % check_grad_parity(
+        models['padded'], models['fused'], batches[0]))
+    for name, model in models.items():
+        print('%s: train %.1f examples/s, embed %.1f examples/s' % (name, bench_train(model, batches, device),
+                                                                  bench_embed(model, batches, device)))
@@ -0,0 +1,57 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import scipy.sparse
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from piqa_evaluate import evaluate, get_predictions, get_q2c, load_phrases
+
+
+def get_reference_predictions(context_emb_dir, question_emb_dir, q2c):
+    """The former `--sparse` path: a sparse product per question, then the max of the densified scores.
+
+    Each context is loaded once, as in `get_predictions`, so that only the scoring differs.
+    """
+    predictions = {}
+    last_cid = None
+    for id_, cid in q2c.items():
+        q_emb_path = os.path.join(question_emb_dir, '%s.npz' % id_)
+        if not os.path.exists(q_emb_path):
+            continue
+        if cid != last_cid:
+            c_emb = scipy.sparse.load_npz(os.path.join(context_emb_dir, '%s.npz' % cid))
+            phrases = load_phrases(context_emb_dir, cid)
+            last_cid = cid
+        q_emb = scipy.sparse.load_npz(q_emb_path)
+        m = np.squeeze(np.array((c_emb * q_emb.T).max(1).todense()), 1)
+        predictions[id_] = phrases[m.argmax(0)]
+    return predictions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of the sparse evaluation vs. densified sparse products')
+    parser.add_argument('dataset_file')
+    parser.add_argument('context_emb_dir')
+    parser.add_argument('question_emb_dir')
+    args = parser.parse_args()
+
+    with open(args.dataset_file, 'r') as fp:
+        dataset = json.load(fp)['data']
+    q2c = get_q2c(dataset)
+
+    start_time = time.time()
+    reference = get_reference_predictions(args.context_emb_dir, args.question_emb_dir, q2c)
+    reference_time = time.time() - start_time
+    start_time = time.time()
+    predictions = get_predictions(args.context_emb_dir, args.question_emb_dir, q2c, sparse=True)
+    duration = time.time() - start_time
+
+    num_diffs = sum(predictions[id_] != phrase for id_, phrase in reference.items())
+    print('reference: %.2fs, %s' % (reference_time, json.dumps(evaluate(dataset, reference))))
+    print('sparse scoring: %.2fs (%.1fx), %s' % (duration, reference_time / duration,
+                                                 json.dumps(evaluate(dataset, predictions))))
+    print('%d of %d predictions differ' % (num_diffs, len(reference)))
@@ -0,0 +1,55 @@
+import argparse
+import os
+import subprocess
+import sys
+
+SQUAD_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Same steps as `main.embed` up to the first batch (excluding data loading, which both paths share)
+FULL = """
+import time
+start_time = time.time()
+import sys
+sys.path.insert(0, %r)
+sys.argv = %r
+import torch
+import baseline
+argument_parser = baseline.ArgumentParser()
+argument_parser.add_arguments()
+args = argument_parser.parse_args()
+interface = baseline.FileInterface(**args.__dict__)
+model = baseline.Model(**args.__dict__)
+processor = baseline.Processor(**args.__dict__)
+interface.bind(processor, model)
+interface.load(args.iteration, session=args.load_dir, slim=%r)
+print(time.time() - start_time)
+"""
+
+EXPORTED = """
+import time
+start_time = time.time()
+import sys
+sys.path.insert(0, %r)
+import piqa_encode
+encoder = piqa_encode.QuestionEncoder(%r)
+print(time.time() - start_time)
+"""
+
+
+def run(code, num_iters):
+    times = [float(subprocess.check_output([sys.executable, '-c', code]).decode('utf-8').strip().split('\n')[-1])
+             for _ in range(num_iters)]
+    return min(times), sum(times) / len(times)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Cold-start time of the question encoder: `main.py` (full and slim '
+                                                 'checkpoint) vs. exported')
+    parser.add_argument('export_dir')
+    parser.add_argument('--num_iters', default=3, type=int)
+    args, main_args = parser.parse_known_args()
+
+    argv = ['main.py', 'baseline', '--mode', 'embed_question'] + main_args
+    print('main.py: min %.2fs, mean %.2fs' % run(FULL % (SQUAD_DIR, argv, False), args.num_iters))
+    print('main.py (slim): min %.2fs, mean %.2fs' % run(FULL % (SQUAD_DIR, argv, True), args.num_iters))
+    print('exported: min %.2fs, mean %.2fs' % run(EXPORTED % (SQUAD_DIR, args.export_dir), args.num_iters))
@@ -0,0 +1,26 @@
+#!/usr/bin/env bash
+# Compares phrase filtering thresholds (`--filter_th`), in number of phrases, index size and official PIQA EM/F1.
+# The model should be trained with `--filter_weight`, e.g. 1.0.
+# Run from `./squad/`: ./scripts/filter_eval.sh ITERATION [other main.py arguments, e.g. --filter_top_n 100]
+set -e
+ITERATION=$1
+shift
+THS=${THS:-"0 0.01 0.03 0.1 0.3"}
+OUTPUT_DIR=${OUTPUT_DIR:-/tmp/piqa/squad}
+SQUAD_DEV_PATH=${SQUAD_DEV_PATH:-$HOME/data/squad/dev-v1.1.json}
+SQUAD_DEV_CONTEXT_PATH=${SQUAD_DEV_CONTEXT_PATH:-$HOME/data/squad/dev-v1.1-context.json}
+SQUAD_DEV_QUESTION_PATH=${SQUAD_DEV_QUESTION_PATH:-$HOME/data/squad/dev-v1.1-question.json}
+
+# Questions do not depend on the filter
+python main.py baseline --mode embed_question --iteration $ITERATION --test_path $SQUAD_DEV_QUESTION_PATH \
+    --output_dir $OUTPUT_DIR "$@" > /dev/null
+
+for TH in $THS; do
+    CONTEXT_EMB_DIR=$OUTPUT_DIR/context_emb_th$TH
+    python main.py baseline --mode embed_context --iteration $ITERATION --test_path $SQUAD_DEV_CONTEXT_PATH \
+        --output_dir $OUTPUT_DIR --context_emb_dir $CONTEXT_EMB_DIR --filter_th $TH "$@" > /dev/null
+    NUM_PHRASES=$(python -c "import glob, os, sys; from piqa_evaluate import load_phrases; print(sum(len(load_phrases(sys.argv[1], os.path.basename(path)[:-5])) for path in glob.glob(sys.argv[1] + '/*.json')))" $CONTEXT_EMB_DIR)
+    SIZE=$(du -sh $CONTEXT_EMB_DIR | cut -f1)
+    RESULT=$(python piqa_evaluate.py $SQUAD_DEV_PATH $CONTEXT_EMB_DIR/ $OUTPUT_DIR/question_emb/)
+    echo "th=$TH: $NUM_PHRASES phrases, context_emb $SIZE; $RESULT"
+done
@@ -0,0 +1,122 @@
+import argparse
+import csv
+import json
+import os
+import random
+import shutil
+import sys
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from piqa_evaluate import evaluate, get_predictions, get_q2c
+
+
+def list_ids(emb_dir):
+    return sorted(name[:-4] for name in os.listdir(emb_dir) if name.endswith('.npz'))
+
+
+def load_emb(emb_dir, id_):
+    return np.load(os.path.join(emb_dir, '%s.npz' % id_))['arr_0']
+
+
+def fit(context_emb_dir, sample_size, seed=0):
+    """Fits the mean and the principal components of (a sample of at most `sample_size`) phrase vectors.
+
+    Returns the mean, and the eigenvectors and eigenvalues of the covariance in decreasing order of eigenvalue.
+    """
+    cids = list_ids(context_emb_dir)
+    random.Random(seed).shuffle(cids)
+    sample, size = [], 0
+    for cid in cids:
+        if size >= sample_size:
+            break
+        emb = load_emb(context_emb_dir, cid)
+        sample.append(emb)
+        size += emb.shape[0]
+    sample = np.concatenate(sample, 0)[:sample_size].astype(np.float64)
+    mean = sample.mean(0)
+    eigvals, eigvecs = np.linalg.eigh(np.cov(sample - mean, rowvar=False))
+    order = np.argsort(eigvals)[::-1]
+    return mean, eigvecs[:, order], np.maximum(eigvals[order], 0)
+
+
+def get_projections(mean, eigvecs, eigvals, dim, whiten=False):
+    """Context and question projections to `dim` dimensions, which preserve the ranking of phrases by inner product.
+
+    Contexts are centered (which only shifts the scores of a question by a constant), and with `whiten`, context
+    components are scaled to unit variance while question components are scaled inversely.
+    """
+    components = eigvecs[:, :dim]
+    scale = np.sqrt(eigvals[:dim]) + 1e-12 if whiten else np.ones(dim)
+    project_context = lambda emb: ((emb - mean) @ components / scale).astype(np.float32)
+    project_question = lambda emb: (emb @ components * scale).astype(np.float32)
+    return project_context, project_question
+
+
+def reduce(context_emb_dir, question_emb_dir, out_dirs, projections):
+    """Writes each context and question with each of `projections`, to the corresponding pair of `out_dirs`."""
+    for out_context_emb_dir, out_question_emb_dir in out_dirs:
+        for dirname in (out_context_emb_dir, out_question_emb_dir):
+            if not os.path.exists(dirname):
+                os.makedirs(dirname)
+    for cid in list_ids(context_emb_dir):
+        emb = load_emb(context_emb_dir, cid)
+        for (out_context_emb_dir, _), (project_context, _) in zip(out_dirs, projections):
+            np.savez(os.path.join(out_context_emb_dir, '%s.npz' % cid), project_context(emb))
+            # phrases (and span offsets) are unchanged
+            for name in ('%s.json' % cid, '%s.spans.npy' % cid):
+                if os.path.exists(os.path.join(context_emb_dir, name)):
+                    shutil.copy(os.path.join(context_emb_dir, name), os.path.join(out_context_emb_dir, name))
+    for id_ in list_ids(question_emb_dir):
+        emb = load_emb(question_emb_dir, id_)
+        for (_, out_question_emb_dir), (_, project_question) in zip(out_dirs, projections):
+            np.savez(os.path.join(out_question_emb_dir, '%s.npz' % id_), project_question(emb))
+
+
+def dir_size(dirname):
+    return sum(os.path.getsize(os.path.join(dirname, name)) for name in os.listdir(dirname))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='PCA of dense phrase and question embeddings')
+    parser.add_argument('context_emb_dir')
+    parser.add_argument('question_emb_dir')
+    parser.add_argument('out_dir', help='reduced embeddings go to `<out_dir>/<dim>/context_emb` and `question_emb`')
+    parser.add_argument('--dims', default='32,64,128,256', type=str, help='comma-separated output dimensions')
+    parser.add_argument('--sample_size', default=100000, type=int, help='number of phrase vectors to fit on')
+    parser.add_argument('--whiten', default=False, action='store_true')
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('--dataset_file', default=None, type=str,
+                        help='if given, evaluate the original and reduced embeddings on it')
+    args = parser.parse_args()
+
+    mean, eigvecs, eigvals = fit(args.context_emb_dir, args.sample_size, seed=args.seed)
+    input_dim = len(mean)
+    dims = [dim for dim in map(int, args.dims.split(',')) if dim < input_dim]
+    print('Fitted on %d-dim phrase vectors' % input_dim)
+
+    out_dirs = [(os.path.join(args.out_dir, str(dim), 'context_emb'),
+                 os.path.join(args.out_dir, str(dim), 'question_emb')) for dim in dims]
+    projections = [get_projections(mean, eigvecs, eigvals, dim, whiten=args.whiten) for dim in dims]
+    reduce(args.context_emb_dir, args.question_emb_dir, out_dirs, projections)
+
+    dataset, q2c = None, None
+    if args.dataset_file is not None:
+        with open(args.dataset_file, 'r') as fp:
+            dataset = json.load(fp)['data']
+        q2c = get_q2c(dataset)
+    rows = []
+    for dim, (context_emb_dir, question_emb_dir) in zip(dims + [input_dim],
+                                                        out_dirs + [(args.context_emb_dir, args.question_emb_dir)]):
+        row = {'dim': dim, 'explained_variance': float(eigvals[:dim].sum() / eigvals.sum()),
+               'context_emb_mb': dir_size(context_emb_dir) / 2 ** 20}
+        if dataset is not None:
+            row.update(evaluate(dataset, get_predictions(context_emb_dir, question_emb_dir, q2c)))
+        rows.append(row)
+        print(', '.join('%s=%.5r' % (key, val) for key, val in row.items()))
+
+    with open(os.path.join(args.out_dir, 'pca.csv'), 'w') as fp:
+        writer = csv.DictWriter(fp, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
@@ -0,0 +1,26 @@
+#!/usr/bin/env bash
+# Compares float32 and dynamic int8 (`--quantize`) question encoders on CPU, in latency and official PIQA EM/F1.
+# Run from `./squad/`: ./scripts/quantize_eval.sh ITERATION [other main.py arguments, e.g. --num_heads 2]
+set -e
+ITERATION=$1
+shift
+OUTPUT_DIR=${OUTPUT_DIR:-/tmp/piqa/squad}
+SQUAD_DEV_PATH=${SQUAD_DEV_PATH:-$HOME/data/squad/dev-v1.1.json}
+SQUAD_DEV_CONTEXT_PATH=${SQUAD_DEV_CONTEXT_PATH:-$HOME/data/squad/dev-v1.1-context.json}
+SQUAD_DEV_QUESTION_PATH=${SQUAD_DEV_QUESTION_PATH:-$HOME/data/squad/dev-v1.1-question.json}
+
+# Contexts are always encoded in float32
+python main.py baseline --mode embed_context --iteration $ITERATION --test_path $SQUAD_DEV_CONTEXT_PATH \
+    --output_dir $OUTPUT_DIR "$@" > /dev/null
+
+for TYPE in float32 int8; do
+    QUANTIZE=""
+    if [ "$TYPE" = "int8" ]; then
+        QUANTIZE="--quantize"
+    fi
+    QUESTION_EMB_DIR=$OUTPUT_DIR/question_emb_$TYPE
+    LATENCY=$(python main.py baseline --mode embed_question --iteration $ITERATION --test_path $SQUAD_DEV_QUESTION_PATH \
+        --output_dir $OUTPUT_DIR --question_emb_dir $QUESTION_EMB_DIR $QUANTIZE "$@" | grep 'Question encoding')
+    RESULT=$(python piqa_evaluate.py $SQUAD_DEV_PATH $OUTPUT_DIR/context_emb/ $QUESTION_EMB_DIR/)
+    echo "$TYPE: $LATENCY; $RESULT"
+done
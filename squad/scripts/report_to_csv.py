@@ -0,0 +1,19 @@
+import argparse
+import csv
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from base import read_report
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Converts a report (JSON lines) to a CSV table, e.g. for plotting')
+    parser.add_argument('report_path')
+    parser.add_argument('csv_path')
+    args = parser.parse_args()
+
+    header, rows = read_report(args.report_path)
+    with open(args.csv_path, 'w') as fp:
+        writer = csv.DictWriter(fp, delimiter=',', fieldnames=header)
+        writer.writeheader()
+        writer.writerows(rows)
@@ -0,0 +1,20 @@
+#!/usr/bin/env bash
+# Compares top-k sparse (`--sparse_k`) phrase and question vectors across k, in index size and official PIQA EM/F1.
+# Run from `./squad/`: ./scripts/sparse_eval.sh ITERATION [other main.py arguments, e.g. --num_heads 2]
+set -e
+ITERATION=$1
+shift
+KS=${KS:-"8 16 32 64 128"}
+OUTPUT_DIR=${OUTPUT_DIR:-/tmp/piqa/squad}
+SQUAD_DEV_PATH=${SQUAD_DEV_PATH:-$HOME/data/squad/dev-v1.1.json}
+
+for K in $KS; do
+    CONTEXT_EMB_DIR=$OUTPUT_DIR/context_emb_k$K
+    QUESTION_EMB_DIR=$OUTPUT_DIR/question_emb_k$K
+    python main.py baseline --mode embed --iteration $ITERATION --test_path $SQUAD_DEV_PATH --output_dir $OUTPUT_DIR \
+        --context_emb_dir $CONTEXT_EMB_DIR --question_emb_dir $QUESTION_EMB_DIR --emb_type sparse --sparse_k $K \
+        "$@" > /dev/null
+    SIZE=$(du -sh $CONTEXT_EMB_DIR | cut -f1)
+    RESULT=$(python piqa_evaluate.py $SQUAD_DEV_PATH $CONTEXT_EMB_DIR/ $QUESTION_EMB_DIR/ --sparse)
+    echo "k=$K: context_emb $SIZE; $RESULT"
+done
@@ -1,9 +1,14 @@
 import argparse
 import json
+import os
+from collections import Counter, OrderedDict
+from functools import partial
+from multiprocessing import Pool
 
 import nltk
-
-from gensim import corpora, models, similarities
+import numpy as np
+import scipy.sparse
+from scipy.sparse import csr_matrix
 from tqdm import tqdm
 
 
@@ -12,7 +17,7 @@ def load_squad(squad_path, draft=False):
         squad = json.load(fp)
         examples = []
         for article in squad['data']:
-            for paragraph in article['paragraphs']:
+            for para_idx, paragraph in enumerate(article['paragraphs']):
                 context = paragraph['context']
                 for qa in paragraph['qas']:
                     question = qa['question']
@@ -29,6 +34,7 @@ def load_squad(squad_path, draft=False):
                     context = context.replace('\n', '\t')
 
                     example = {'id': id_,
+                               'cid': '%s_%d' % (article['title'], para_idx),
                                'idx': len(examples),
                                'context': context,
                                'question': question,
@@ -64,6 +70,84 @@ def get_phrases_and_documents(context, nbr_len=7, max_ans_len=7, lower=False):
     return phrases, documents
 
 
+def get_counts(texts, vocab):
+    """Term counts of `texts` (lists of words) as a CSR matrix over `vocab` (word to id), ignoring other words."""
+    rows = [i for i, text in enumerate(texts) for word in text if word in vocab]
+    cols = [vocab[word] for text in texts for word in text if word in vocab]
+    counts = csr_matrix((np.ones(len(cols)), (rows, cols)), shape=(len(texts), len(vocab)))
+    counts.sum_duplicates()
+    return counts
+
+
+def get_idf(num_documents, df):
+    """Same as gensim's default `TfidfModel`: log2(num_documents / document_frequency)."""
+    return np.log2(num_documents / np.maximum(df, 1))
+
+
+def get_tfidf(counts, idf):
+    """L2-normalized TF-IDF (raw term counts times IDF, as gensim's default `TfidfModel`)."""
+    return _normalize(csr_matrix(counts.multiply(idf)))
+
+
+def predict_paragraph(paragraph, nbr_len=7, max_ans_len=7, lower=False):
+    """Predicts the phrase of each question of a paragraph, given as (context, [(id, question), ...]).
+
+    The phrase documents (and their TF-IDF, with the IDF of this paragraph) are built once per paragraph, and all of its
+    questions are scored with a single sparse matrix product. Scores are in float32, like gensim's `MatrixSimilarity`.
+    """
+    context, questions = paragraph
+    phrases, documents = get_phrases_and_documents(context, nbr_len=nbr_len, max_ans_len=max_ans_len, lower=lower)
+    if len(phrases) == 0:
+        return [(id_, '') for id_, _ in questions]
+    vocab = {}
+    for document in documents:
+        for word in document:
+            vocab.setdefault(word, len(vocab))
+    counts = get_counts(documents, vocab)
+    idf = get_idf(len(documents), np.bincount(counts.indices, minlength=len(vocab)))
+    doc_mat = get_tfidf(counts, idf)
+    query_mat = get_tfidf(get_counts([tokenize(question) for _, question in questions], vocab), idf)
+    scores = (doc_mat.astype(np.float32) * query_mat.astype(np.float32).T).toarray()
+    return [(id_, phrases[idx]) for (id_, _), idx in zip(questions, np.argmax(scores, 0))]
+
+
+def count_document_frequencies(paragraph, nbr_len=7, max_ans_len=7, lower=False):
+    """Returns the number of phrase documents of a paragraph, and the number of those containing each word."""
+    context, _ = paragraph
+    _, documents = get_phrases_and_documents(context, nbr_len=nbr_len, max_ans_len=max_ans_len, lower=lower)
+    return len(documents), Counter(word for document in documents for word in set(document))
+
+
+def export_paragraph(item, context_emb_dir, question_emb_dir, nbr_len=7, max_ans_len=7, lower=False):
+    """Saves the TF-IDF phrase matrix of a paragraph, given as (cid, (context, [(id, question), ...])), and the TF-IDF
+    vectors of its questions, with the global vocabulary and IDF (see `_init_export`), in the PIQA sparse format.
+
+    Returns the number of phrases and of non-zero entries.
+    """
+    cid, (context, questions) = item
+    phrases, documents = get_phrases_and_documents(context, nbr_len=nbr_len, max_ans_len=max_ans_len, lower=lower)
+    doc_mat = get_tfidf(get_counts(documents, _vocab), _idf).astype(np.float32)
+    scipy.sparse.save_npz(os.path.join(context_emb_dir, '%s.npz' % cid), doc_mat)
+    with open(os.path.join(context_emb_dir, '%s.json' % cid), 'w') as fp:
+        json.dump(phrases, fp)
+    query_mat = get_tfidf(get_counts([tokenize(question) for _, question in questions], _vocab), _idf)
+    for (id_, _), query_vec in zip(questions, query_mat.astype(np.float32)):
+        scipy.sparse.save_npz(os.path.join(question_emb_dir, '%s.npz' % id_), query_vec)
+    return len(phrases), doc_mat.nnz
+
+
+def _init_export(vocab, idf):
+    # Shared by all paragraphs of a worker process, instead of being pickled for each of them
+    global _vocab, _idf
+    _vocab, _idf = vocab, idf
+
+
+def _normalize(mat):
+    norms = np.sqrt(np.asarray(mat.multiply(mat).sum(1))).flatten()
+    norms[norms == 0] = 1.0
+    return csr_matrix(mat.multiply(1.0 / norms[:, None]))
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='TF-IDF')
     parser.add_argument('data_path')
@@ -72,32 +156,58 @@ if __name__ == '__main__':
     parser.add_argument('--nbr_len', default=7, type=int)
     parser.add_argument('--max_ans_len', default=7, type=int)
     parser.add_argument('--lower', default=False, action='store_true')
+    parser.add_argument('--num_procs', default=None, type=int, help='number of processes (default: all CPUs)')
+    parser.add_argument('--context_emb_dir', default=None, type=str,
+                        help='if given, also export the phrase vectors in the PIQA sparse format')
+    parser.add_argument('--question_emb_dir', default=None, type=str)
     args = parser.parse_args()
 
     examples = load_squad(args.data_path, draft=args.draft)
+    if args.draft:
+        examples = examples[:1]
+        print(examples[0]['question'])
+
+    # questions grouped by paragraph, in order
+    paragraphs = OrderedDict()
+    for example in examples:
+        paragraphs.setdefault(example['cid'], (example['context'], []))[1].append((example['id'], example['question']))
 
+    kwargs = dict(nbr_len=args.nbr_len, max_ans_len=args.max_ans_len, lower=args.lower)
     out_dict = {}
-    for example in tqdm(examples):
-        query = tokenize(example['question'])
-        phrases, documents = get_phrases_and_documents(example['context'],
-                                                       nbr_len=args.nbr_len,
-                                                       max_ans_len=args.max_ans_len,
-                                                       lower=args.lower)
-        dictionary = corpora.Dictionary(documents)
-        corpus = [dictionary.doc2bow(doc) for doc in documents]
-        tfidf = models.TfidfModel(corpus)
-        index = similarities.MatrixSimilarity(tfidf[corpus])
-        sims = index[tfidf[dictionary.doc2bow(query)]]
-        phrase = phrases[max(enumerate(sims), key=lambda item: item[1])[0]]
-        out_dict[example['id']] = phrase
-        if args.draft:
-            print(example['question'])
-            break
+    with Pool(args.num_procs) as pool:
+        for results in tqdm(pool.imap(partial(predict_paragraph, **kwargs), paragraphs.values(), chunksize=8),
+                            total=len(paragraphs)):
+            out_dict.update(results)
 
     with open(args.out_path, 'w') as fp:
         json.dump(out_dict, fp)
 
-
-
-
-
+    if args.context_emb_dir is not None:
+        assert args.question_emb_dir is not None, '`--question_emb_dir` is required with `--context_emb_dir`.'
+        print('Computing the global vocabulary and IDF')
+        num_documents, df = 0, Counter()
+        with Pool(args.num_procs) as pool:
+            for each_num_documents, each_df in pool.imap(partial(count_document_frequencies, **kwargs),
+                                                         paragraphs.values(), chunksize=8):
+                num_documents += each_num_documents
+                df.update(each_df)
+        words = sorted(df)
+        vocab = {word: idx for idx, word in enumerate(words)}
+        idf = get_idf(num_documents, np.array([df[word] for word in words]))
+
+        print('Exporting phrase vectors (vocabulary size %d)' % len(vocab))
+        for dirname in (args.context_emb_dir, args.question_emb_dir):
+            if not os.path.exists(dirname):
+                os.makedirs(dirname)
+        export = partial(export_paragraph, context_emb_dir=args.context_emb_dir,
+                         question_emb_dir=args.question_emb_dir, **kwargs)
+        num_phrases, nnz = 0, 0
+        with Pool(args.num_procs, initializer=_init_export, initargs=(vocab, idf)) as pool:
+            for each_num_phrases, each_nnz in tqdm(pool.imap(export, paragraphs.items(), chunksize=8),
+                                                   total=len(paragraphs)):
+                num_phrases += each_num_phrases
+                nnz += each_nnz
+        size = sum(os.path.getsize(os.path.join(args.context_emb_dir, name))
+                   for name in os.listdir(args.context_emb_dir))
+        print('%d phrases, %.1f non-zeros per phrase, %.1f MB of context embeddings' % (
+            num_phrases, nnz / max(num_phrases, 1), size / 2 ** 20))
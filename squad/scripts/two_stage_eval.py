@@ -0,0 +1,104 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from piqa_evaluate import evaluate, get_q2c
+from piqa_index import PhraseIndex
+
+
+def get_tfidf_candidates(dataset, cids, top_p):
+    """Top `top_p` of `cids` per question id, by TF-IDF similarity of the paragraph and question texts.
+
+    Cids that are not in `dataset` have no text, so they are skipped (with a warning).
+    """
+    from scripts.tfidf import get_counts, get_idf, get_tfidf, tokenize
+    paragraphs, questions = {}, []
+    for article in dataset:
+        for para_idx, paragraph in enumerate(article['paragraphs']):
+            paragraphs['%s_%d' % (article['title'], para_idx)] = paragraph['context']
+            questions.extend((qa['id'], qa['question']) for qa in paragraph['qas'])
+    unknown = [cid for cid in cids if cid not in paragraphs]
+    if unknown:
+        print('Warning: skipping %d indexed contexts that are not in the dataset, e.g. %s' % (len(unknown), unknown[0]),
+              file=sys.stderr)
+        cids = [cid for cid in cids if cid in paragraphs]
+    if len(cids) == 0:
+        return {id_: [] for id_, _ in questions}
+    documents = [tokenize(paragraphs[cid]) for cid in cids]
+    vocab = {}
+    for document in documents:
+        for word in document:
+            vocab.setdefault(word, len(vocab))
+    counts = get_counts(documents, vocab)
+    idf = get_idf(len(documents), np.bincount(counts.indices, minlength=len(vocab)))
+    doc_mat = get_tfidf(counts, idf)
+    query_mat = get_tfidf(get_counts([tokenize(question) for _, question in questions], vocab), idf)
+    candidates = {}
+    for (id_, _), query_vec in zip(questions, query_mat):
+        scores = (doc_mat * query_vec.T).toarray()[:, 0]
+        candidates[id_] = [cids[idx] for idx in np.argsort(-scores, kind='stable')[:top_p]]
+    return candidates
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Two-stage (paragraph pre-filter, then phrase) retrieval over a '
+                                                 'phrase index, with recall@P and open-domain EM/F1')
+    parser.add_argument('dataset_file')
+    parser.add_argument('index_dir', help='phrase index (`piqa_index.py`) of the context embeddings')
+    parser.add_argument('question_emb_dir')
+    parser.add_argument('--top_ps', default='1,5,10,50', type=str, help='comma-separated numbers of candidates')
+    parser.add_argument('--prefilter', default='max', type=str,
+                        help='max|mean (of the phrase vectors of each context)|tfidf (of the paragraph text)')
+    args = parser.parse_args()
+
+    with open(args.dataset_file, 'r') as fp:
+        dataset = json.load(fp)['data']
+    q2c = get_q2c(dataset)
+    snapshot = PhraseIndex(args.index_dir).snapshot()
+    top_ps = [min(top_p, len(snapshot)) for top_p in map(int, args.top_ps.split(','))]
+    tfidf_candidates = None
+    if args.prefilter == 'tfidf':
+        tfidf_candidates = get_tfidf_candidates(dataset, snapshot.summaries()[0], max(top_ps))
+
+    # Candidates are scored in rank order, so every P is evaluated from the scores of the largest P
+    predictions = [{} for _ in top_ps]
+    hits = [0 for _ in top_ps]
+    num_phrases = [0 for _ in top_ps]
+    num_questions = 0
+    start_time = time.time()
+    for id_, cid in q2c.items():
+        q_emb_path = os.path.join(args.question_emb_dir, '%s.npz' % id_)
+        if not os.path.exists(q_emb_path):
+            continue
+        q_emb = np.load(q_emb_path)['arr_0']  # shape = [M, d]
+        if tfidf_candidates is not None:
+            candidates = tfidf_candidates[id_]
+        else:
+            candidates = snapshot.candidates(q_emb.max(0), max(top_ps), summary=args.prefilter)
+        best = []  # (score, phrase) of the best phrase of each candidate
+        for each in candidates:
+            c_emb, phrases = snapshot.context(each)
+            m = np.matmul(c_emb, q_emb.T).max(1)
+            best.append((m.max(), len(m), phrases, m.argmax(0)))
+        for i, top_p in enumerate(top_ps):
+            if len(best[:top_p]) == 0:
+                continue  # an empty index; no prediction
+            score, _, phrases, argmax = max(best[:top_p], key=lambda x: x[0])
+            predictions[i][id_] = phrases[argmax]
+            hits[i] += cid in candidates[:top_p]
+            num_phrases[i] += sum(each[1] for each in best[:top_p])
+        num_questions += 1
+    duration = time.time() - start_time
+
+    print('%d questions, %d contexts, %.1f ms per question' % (num_questions, len(snapshot),
+                                                               duration * 1000 / max(num_questions, 1)))
+    for i, top_p in enumerate(top_ps):
+        result = {'top_p': top_p, 'recall': hits[i] / max(num_questions, 1),
+                  'phrases_per_question': num_phrases[i] / max(num_questions, 1)}
+        result.update(evaluate(dataset, predictions[i]))
+        print(json.dumps(result))